@@ -7,6 +7,7 @@ from ast import literal_eval
 from utils import *
 from block import *
 from peer import Peer
+from miner import Miner
 from threading import Thread
 
 
@@ -58,21 +59,21 @@ class App(Peer):
 
     def get_local_blockchain(self):
         '''
-        Get the local blockchain.
+        Get the last 12 blocks of the local blockchain, genesis block excluded.
+        Only their bodies are read, this runs every frame.
         '''
-        bc_copy = self.block_chain.chain[1:]
-        if (len(bc_copy) > 12):
-            bc_copy = bc_copy[-12:]
-        return bc_copy
+        with self.handler_lock:
+            chain = self.block_chain.chain
+            return chain[max(1, len(chain) - 12):]
 
-    def get_song_info(self, block:Block):
+    def get_song_info(self, transaction:str):
         '''
-        Get song's info for displaying it on the main screen.
+        Get song's info of a serialized transaction for displaying it on the main screen.
 
         Info format : [Author name] created [Song name] on [Timestamp].
         Returns : (author_name, song_name, timestamp) in seconds.
         '''
-        ts = literal_eval(block.data)
+        ts = literal_eval(transaction)
         author_name = ts['user_name']
         song_name   = ts['song_name']
         timestamp   = datetime.strptime(ts['timestamp'], '%Y-%m-%d %H:%M:%S.%f').strftime('%H:%M:%S')
@@ -80,12 +81,9 @@ class App(Peer):
     
     def get_remote_artists(self):
         '''
-        FIXME : Get the list of artists from the remote peers.
+        Get the artists known to the network, i.e. the ones on chain.
         '''
-        remote_artists = []
-        for peer in self.peer_list:
-            self.send_message(peer, "GET_ARTISTS")
-        return remote_artists
+        return self.block_chain.state.artists
 
     def ts_valid_check(self, type:str):
         '''
@@ -128,22 +126,9 @@ class App(Peer):
             elif self.sender == self.receiver:
                 self.error_message = "Sending a song to yourself, huh ?"
             else:
-                for block in self.get_local_blockchain():
-                    # get the info of the song.
-                    transaction = json.loads(block.data)
-                    if transaction['transaction_type'] == 'Register' and transaction['song_name'] == self.song:
-                        song_owner = transaction['user_name']
-                        continue
-                    elif transaction['transaction_type'] == 'Transfer' and transaction['song_name'] == self.song:
-                        song_owner = transaction['other_user']
-                        continue
-                if not song_owner:
-                    self.error_message = "Song has not been registered yet !"
-                elif song_owner != self.sender:
-                    self.error_message = "You are not the owner !"
-                elif song_owner == self.receiver:
-                    self.error_message = "Looks like the receiver already has the song !"
-                else:
+                # Ownership comes from the state index, kept up to date as blocks are added.
+                self.error_message = self.block_chain.state.check_transfer(self.sender, self.song, self.receiver) or ''
+                if not self.error_message:
                     return True
 
     def handle_user_input(self, event, user_input):
@@ -160,9 +145,6 @@ class App(Peer):
         else:
             print("Something is wrong with the user input!")
 
-    def get_local_blockchain(self):
-        return self.block_chain.chain[1:]
-    
     def make_app_transaction(self, type:str):
         '''
         Create a new transaction and add it to the transaction pool.
@@ -255,12 +237,13 @@ class App(Peer):
             font = pygame.font.Font('../asset/Sedan.ttf', 19)
             y = 160
             for block in blockchain:
-                author_name, song_name, timestamp = self.get_song_info(block)
-                text = font.render(f"{author_name} created {song_name} on {timestamp}", True, self.black_color)
-                text_rect = text.get_rect(center=(550, y+6))
-                pygame.draw.line(screen, (0,0,0), (325, y + 20), (773, y + 20), 2)
-                screen.blit(text, text_rect)
-                y += 30
+                for transaction in block.transactions:
+                    author_name, song_name, timestamp = self.get_song_info(transaction)
+                    text = font.render(f"{author_name} created {song_name} on {timestamp}", True, self.black_color)
+                    text_rect = text.get_rect(center=(550, y+6))
+                    pygame.draw.line(screen, (0,0,0), (325, y + 20), (773, y + 20), 2)
+                    screen.blit(text, text_rect)
+                    y += 30
 
         # Add sync button at the bottom.
         sync_button = pygame.draw.rect(screen, (49, 54, 63), (480, 535, 175, 50))
@@ -429,6 +412,7 @@ class App(Peer):
         '''
         Start the Peer node.
         '''
+        self.miner = Miner(self.mine_workers)
         self.join()
         Thread(target=self.listen, daemon=True).start()
         Thread(target=self.heartbeat, daemon=True).start()
@@ -1,5 +1,6 @@
 import json
 from utils import *
+from merkle import MerkleTree, verify_proof
 
 
 class Transaction:
@@ -53,58 +54,283 @@ class Transfer(Transaction):
         return f"User : {self.user_name} transferred a song."
 
 
-class Block:
-    def __init__(self, index, timestamp, transaction:str, previous_hash:str, signature:str, difficulty:str, nonce=0, mine_time=-1):
-        self.index = index
+class BlockHeader:
+    '''
+    The hashed part of a block. Uses __slots__ instead of a per-instance
+    __dict__, and becomes immutable once sealed (after mining or when added
+    to a chain). A sealed header computes its digest once and caches it.
+    The hashes are kept as raw 32-byte digests, their hex forms are derived
+    when they are read.
+    '''
+    __slots__ = ('index', 'timestamp', 'previous_digest', 'mrkl_digest', 'difficulty', 'nonce', 'digest')
+
+    def __init__(self, index, timestamp, previous_hash, mrkl_root, difficulty:int, nonce=0):
+        """
+        {previous_hash} and {mrkl_root} are given as hex strings, or as raw digests.
+        """
+        self.index = int(index)
         self.timestamp = timestamp
-        self.previous_hash = previous_hash
-        self.nonce = nonce 
-        self.mine_time = mine_time
+        self.previous_digest = previous_hash if isinstance(previous_hash, bytes) else bytes.fromhex(previous_hash)
+        self.mrkl_digest = mrkl_root if isinstance(mrkl_root, bytes) else bytes.fromhex(mrkl_root)
+        self.difficulty = int(difficulty)   # 256-bit target
+        self.nonce = int(nonce)
+        self.digest = None                  # Raw digest, set when sealed.
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'digest', None) is not None:
+            raise AttributeError("A sealed block header can't be modified.")
+        object.__setattr__(self, name, value)
+
+    @property
+    def hash(self):
+        """
+        Hex digest, None until sealed.
+        """
+        return None if self.digest is None else self.digest.hex()
+
+    @property
+    def previous_hash(self):
+        return self.previous_digest.hex()
+
+    @property
+    def mrkl_root(self):
+        return self.mrkl_digest.hex()
+
+    def prefix(self):
+        """
+        Everything that is hashed before the nonce. It doesn't change while mining,
+        and its size doesn't depend on the number of transactions.
+        """
+        return header_prefix(self.index, self.timestamp, self.previous_hash, self.mrkl_root)
+
+    def calc_digest(self):
+        """
+        Calculate the raw sha256 digest of the header. Free once sealed.
+        """
+        if self.digest is not None:
+            return self.digest
+        return sha256(self.prefix() + b'%d' % self.nonce).digest()
+
+    def seal(self, digest:bytes=None):
+        """
+        Freeze the header and cache its digest. A known digest (e.g. read
+        back from our own store) can be given to skip hashing.
+        """
+        if self.digest is None:
+            digest = bytes(digest) if digest is not None else self.calc_digest()
+            object.__setattr__(self, 'digest', digest)
+
+    def serialize(self):
+        """
+        Store the block header as a json. Enough to check the PoW of the block
+        and the merkle proofs of its transactions, without the body.
+        """
+        serialized_hdr = {
+            'hash':         self.calc_digest().hex(),
+            'index':        str(self.index),
+            'timestamp':    str(self.timestamp),
+            'previous_hash':self.previous_hash,
+            'mrkl_root':    self.mrkl_root,
+            'difficulty':   str(self.difficulty),
+            'nonce':        str(self.nonce)
+        }
+        return json.dumps(serialized_hdr)
+
+
+class BlockBody:
+    '''
+    The part of a block that is not hashed directly: the transactions (committed
+    to by the header's merkle root) and the miner's metadata.
+    '''
+    __slots__ = ('transactions', 'signature', 'mine_time')
+
+    def __init__(self, transactions:list, signature:str, mine_time=-1):
+        self.transactions = transactions    # A list of serialized transactions.
         self.signature = signature
-        self.difficulty = difficulty
+        self.mine_time = mine_time
+
+
+class Block:
+    '''
+    A header and a body. Blockchain stores them separately and puts them
+    back together when a Block is needed.
+    '''
+    __slots__ = ('header', 'body', 'mrkl_tree')
 
-        # Body of the block
-        self.data = transaction
-        self.hash = self.calc_hash()
+    def __init__(self, index, timestamp, transactions:list, previous_hash:str, signature:str, difficulty:int, nonce=0, mine_time=-1):
+        # The header commits to the transactions through their merkle root only.
+        self.mrkl_tree = MerkleTree([sha256(ts.encode()).digest() for ts in transactions])
+        self.header = BlockHeader(index, timestamp, previous_hash, self.mrkl_tree.root(), difficulty, nonce)
+        self.body = BlockBody(transactions, signature, mine_time)
 
-        # Not used for now
-        self.mrkl_root = calc_mrkl_root(transaction)
+    @classmethod
+    def from_parts(cls, header:BlockHeader, body:BlockBody):
+        """
+        Put a block back together from a stored header and body.
+        """
+        block = cls.__new__(cls)
+        block.header = header
+        block.body = body
+        block.mrkl_tree = None
+        return block
+
+    index = property(lambda self: self.header.index)
+    timestamp = property(lambda self: self.header.timestamp)
+    previous_hash = property(lambda self: self.header.previous_hash)
+    mrkl_root = property(lambda self: self.header.mrkl_root)
+    difficulty = property(lambda self: self.header.difficulty)
+    transactions = property(lambda self: self.body.transactions)
+    signature = property(lambda self: self.body.signature)
+
+    @property
+    def nonce(self):
+        return self.header.nonce
+
+    @nonce.setter
+    def nonce(self, value):
+        self.header.nonce = int(value)
+
+    @property
+    def mine_time(self):
+        return self.body.mine_time
+
+    @mine_time.setter
+    def mine_time(self, value):
+        self.body.mine_time = value
+
+    @property
+    def hash(self):
+        return self.header.hash or self.calc_hash()
+
+    def seal(self):
+        """
+        Freeze the header once the block is mined or accepted. The merkle
+        tree is only needed while building the block and is dropped.
+        """
+        self.header.seal()
+        self.mrkl_tree = None
+
+    def check_mrkl_root(self):
+        """
+        Whether the transactions are the ones the header commits to. A body
+        with a transaction twice is rejected: as the last node of an odd level
+        is paired with itself, [a, b, c] and [a, b, c, c] have the same root.
+        """
+        if len(set(self.transactions)) != len(self.transactions):
+            return False
+        tree = self.mrkl_tree or MerkleTree([sha256(ts.encode()).digest() for ts in self.transactions])
+        return tree.root() is not None and tree.root() == self.header.mrkl_digest
+
+    def add_transaction(self, ts:str):
+        """
+        Append a transaction to a block that is not mined yet. Only the path
+        of the new leaf in the merkle tree is rehashed.
+        """
+        self.body.transactions.append(ts)
+        self.mrkl_tree.append(sha256(ts.encode()).digest())
+        self.header.mrkl_digest = self.mrkl_tree.root()
+
+    def header_prefix(self):
+        """
+        Everything that is hashed before the nonce.
+        """
+        return self.header.prefix()
+
+    def calc_digest(self):
+        """
+        Calculate the raw sha256 digest of the block
+        """
+        return self.header.calc_digest()
 
     def calc_hash(self):
         """
         Calculate the hash of the block's data
         """
-        return sha256(
-            (str(self.index) + str(self.timestamp) + str(self.previous_hash) +\
-             str(self.nonce) + self.data).encode()).hexdigest()
+        return self.calc_digest().hex()
 
     def serialize_block(self):
         """
         Store Block object data as a json
         """
-        self.hash = self.calc_hash() # Update the hash before serialization.
         serialized_blk = {
-            'hash':         self.hash,
+            'hash':         self.calc_hash(),
             'index':        str(self.index),
             'timestamp':    str(self.timestamp),
             'mine_time':    str(self.mine_time),
-            'data':         self.data,
+            'transactions': self.transactions,
+            'mrkl_root':    self.mrkl_root,
             'previous_hash':self.previous_hash,
             'signature':    self.signature,
-            'difficulty':   self.difficulty,
+            'difficulty':   str(self.difficulty),
             'nonce':        str(self.nonce)
         }
         return json.dumps(serialized_blk)
     
-    def mine(self):
+    @classmethod
+    def deserialize_block(cls, data:str):
+        """
+        Build a Block from the json made by serialize_block().
+        """
+        b = json.loads(data)
+        return cls(b['index'], b['timestamp'], b['transactions'], b['previous_hash'], b['signature'],
+                   b['difficulty'], b['nonce'], b['mine_time'])
+
+    def serialize_header(self):
+        """
+        Store the block header as a json.
+        """
+        return self.header.serialize()
+
+    def mrkl_proof(self, ts_index:int):
+        """
+        Merkle inclusion proof of the {ts_index}-th transaction of the block.
+        Every step is [sibling hash, side], side is 'L' if the sibling is on the left.
+        """
+        tree = self.mrkl_tree or MerkleTree([sha256(ts.encode()).digest() for ts in self.transactions])
+        return [[sibling.hex(), 'L' if is_left else 'R'] for sibling, is_left in tree.proof(ts_index)]
+
+    def mine(self, miner=None, cancel=None):
         '''
         Proof of Work. 
-        Loop till it finds a hash that starts with {self.difficulty} number of zeros.
+        Loop till it finds a hash that is smaller than the target {self.difficulty}.
+        If a Miner is given, the search is spread over its worker processes.
+        If the cancel event gets set, mining stops within a few milliseconds.
+        The header is sealed once a nonce is found.
+
+        Returns : True if the block was mined, False if it was cancelled.
         '''
 
-        while True:
-            self.hash = self.calc_hash()
-            if meet_hash_criteria(self.hash, self.difficulty):
-                break
-            self.nonce += 1
-        self.mine_time = time_difference(self.timestamp, datetime.now().strftime("%m/%d/%Y, %H:%M:%S"))
\ No newline at end of file
+        if miner:
+            if not miner.mine(self, cancel):
+                return False
+        else:
+            # The sha256 state after the header prefix is computed once and copied for every nonce.
+            midstate = sha256(self.header_prefix())
+            target = target_bytes(self.difficulty)
+            nonce = self.nonce
+            while True:
+                if cancel and cancel.is_set():
+                    return False
+                found = find_nonce(midstate, target, nonce, 1, CHECK_INTERVAL)
+                if found is not None:
+                    break
+                nonce += CHECK_INTERVAL
+            self.nonce = found
+        self.seal()
+        self.mine_time = time_difference(self.timestamp, datetime.now().strftime("%m/%d/%Y, %H:%M:%S"))
+        return True
+
+
+def verify_ts_proof(ts_hash:str, proof:list, header:dict):
+    '''
+    Verifies that a transaction is in a block using only the block header
+    (as produced by Block.serialize_header()):
+        - The header hashes to its hash and meets its target.
+        - The merkle proof leads from the transaction hash to the header's merkle root.
+    '''
+    digest = BlockHeader(header['index'], header['timestamp'], header['previous_hash'], header['mrkl_root'],
+                         header['difficulty'], header['nonce']).calc_digest()
+    if digest.hex() != header['hash'] or not meet_hash_criteria(digest, int(header['difficulty'])):
+        return False
+    proof = [(bytes.fromhex(sibling), side == 'L') for sibling, side in proof]
+    return verify_proof(bytes.fromhex(ts_hash), proof, bytes.fromhex(header['mrkl_root']))
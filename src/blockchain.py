@@ -1,35 +1,637 @@
+import os
 from block import *
-from utils import meet_hash_criteria
+from datetime import timedelta
+from utils import meet_hash_criteria, retarget, block_work, median_time, timestamp_valid, MAX_TARGET, RETARGET_WINDOW, TIME_FORMAT
+from store import BodyCache, RecordFile
+from codec import CodecError, encode_block, decode_block, decode_header, encode_stored_header, decode_stored_headers, STORED_HEADER
+from state import SongState, snapshot_hash
+from history import HistoryIndex, page, time_range
+from validation import hash_headers, make_pool, PARALLEL_THRESHOLD
+
+class ChainView:
+    """
+    Read-only, list-like view of a Blockchain. Blocks are put together from
+    the stored header and body when they are accessed.
+    """
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+
+    def __len__(self):
+        return len(self.blockchain.headers)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.blockchain.get_block(h) for h in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chain index out of range")
+        return self.blockchain.get_block(i)
+
+    def __iter__(self):
+        for h in range(len(self)):
+            yield self.blockchain.get_block(h)
+
+    def __reversed__(self):
+        for h in range(len(self) - 1, -1, -1):
+            yield self.blockchain.get_block(h)
+
+
+# Side branches whose own tip is more than this many blocks below ours are forgotten.
+# State undo records are kept for as many blocks, deeper reorgs rebuild the state.
+MAX_FORK_DEPTH = 100
+
+# A snapshot of the state is taken every SNAPSHOT_INTERVAL blocks.
+SNAPSHOT_INTERVAL = 100
+
+# The history index is saved in the store every HISTORY_INTERVAL blocks. After
+# a restart, only the blocks after the saved one are indexed again.
+HISTORY_INTERVAL = 1000
+
 
 class Blockchain:
-    def __init__(self, my_ip):
+    """
+    The main chain is stored as headers and bodies indexed by height. Blocks
+    of competing branches are kept in a tree keyed by hash (side_blocks, each
+    linked to its parent by previous_hash). The main chain is always the
+    branch with the most cumulative work; when a side branch overtakes it,
+    only the blocks after the fork point are rolled back and re-applied.
+    """
+    def __init__(self, my_ip, store=None, body_window=None, cache_bytes=8 * 1024 * 1024):
         self.my_ip = my_ip
-        self.chain = []
-        self.genesis_block()
+        self.headers = []       # Sealed block headers. Also the height index: self.headers[h].index == h.
+        self.bodies = {}        # key: block hash. value: BlockBody.
+        self.hash_index = {}    # key: block hash. value: height of the block.
+        self.chain = ChainView(self)
+
+        self.side_blocks = {}   # key: block hash. value: sealed Block that is not on the main chain.
+        self.work = {}          # key: block hash (main or side). value: cumulative work up to the block.
+        self.state = SongState()    # Song ownership on the main chain, follows appends and reorgs.
+        self.history = HistoryIndex()   # Transactions by artist and song, blocks by signer and time.
+                                        # None after a restart, until its first query.
+        # Blocks add_block() took off and put on the main chain, since the last take_changes().
+        self.disconnected = []
+        self.connected = []
+
+        # Optional ChainStore. Every appended block is persisted, and a restarted
+        # peer resumes from the stored chain instead of mining a new genesis block.
+        self.store = store
+        # The headers of the stored blocks and their cumulative work, next to the store.
+        self.header_file = None
+        if store is not None:
+            self.header_file = RecordFile(os.path.join(store.directory, "headers.dat"), STORED_HEADER.size, store.sync)
+
+        # Memory-bounded mode (needs a store). Only the bodies of the last {body_window}
+        # blocks stay in self.bodies, older ones are read back through an LRU cache.
+        self.body_window = body_window if store is not None else None
+        self.body_cache = BodyCache(self.load_body, cache_bytes)
+
+        # Latest state snapshot, (height, canonical JSON). A snapshot received from a peer
+        # or saved in the store is pending until the block it is tied to is appended:
+        # the blocks up to it are not replayed, the state is taken from the snapshot.
+        self.snapshot = None
+        self.pending_snapshot = None    # (state, height, block hash)
+
+        # Every block up to this height has been validated. is_chain_valid() only checks the blocks after it.
+        self.verified_height = 0
+        # Hashes long runs of headers again (see validation.py). Made for the first one.
+        self.validation_pool = None
+        if self.store is not None and len(self.store):
+            self.load_from_store()
+        else:
+            self.genesis_block()
+
+    def load_from_store(self):
+        """
+        Resume the chain from the store. The headers and their work are read
+        from the headers file in one go, and not rehashed (the store keeps the
+        hash of every block). Only the blocks missing from it, e.g. after a
+        crash, are read from the store. Bodies are read when they are needed.
+        The state is resumed from the saved snapshot, only the blocks after it
+        are replayed, and the history index is built on its first query.
+        """
+        count = min(len(self.header_file), len(self.store))
+        try:
+            stored = decode_stored_headers(self.header_file.read(count))
+        except CodecError as e:
+            print(f"The headers file is unreadable ({e}). Reading the headers from the blocks.")
+            stored = []
+        # It must describe the same blocks as the store.
+        if stored and stored[-1][1] != self.read_header(len(stored) - 1).digest:
+            print("The headers file doesn't match the stored blocks. Reading the headers from the blocks.")
+            stored = []
+        for height, (header, digest, work) in enumerate(stored):
+            header.seal(digest)
+            self.work[header.hash] = work
+            self.hash_index[header.hash] = height
+            self.headers.append(header)
+
+        self.header_file.truncate(len(stored))
+        for height in range(len(stored), len(self.store)):
+            header = self.read_header(height)
+            parent_work = self.work[self.parent_hash(header)] if height else 0
+            self.work[header.hash] = parent_work + block_work(header.difficulty)
+            self.hash_index[header.hash] = height
+            self.headers.append(header)
+            self.header_file.append(encode_stored_header(header, self.work[header.hash]))
+        self.history = None
+        self.resume_state(self.store.load_meta("snapshot.json"))
+        # The blocks replayed into the state are validated again, from their headers.
+        if not self.is_chain_valid():
+            print(f"Stored block {self.verified_height + 1} is invalid. Dropping it and the blocks after it.")
+            while len(self.headers) - 1 > self.verified_height:
+                self.disconnect_tip()
+        print(f"Loaded {len(self.headers)} blocks from the local store.")
+
+    def read_header(self, height:int):
+        """
+        Reads the header of the block at {height} from the store, sealed with its stored hash.
+        """
+        with self.store.lock:
+            data = self.store.get(height)
+            if data[:1] == b'{':
+                block = Block.deserialize_block(bytes(data).decode())
+                block.seal()
+                return block.header
+            header, digest = decode_header(data)
+        header.seal(digest)
+        return header
+
+    def resume_state(self, saved:bytes=None):
+        """
+        Take the state from the saved snapshot if it is on the chain, and
+        replay the blocks after it. Without one, the whole chain is replayed.
+        """
+        try:
+            state, height, blk_hash = SongState.from_snapshot(saved) if saved is not None else (None, 0, None)
+        except (ValueError, KeyError, TypeError):
+            print("The saved snapshot is malformed. Replaying the chain.")
+            state = None
+        if state is not None and height < len(self.headers) and self.headers[height].hash == blk_hash:
+            self.state = state
+            self.snapshot = (height, saved)
+            self.verified_height = height
+            self.replay_state(height + 1)
+        else:
+            self.rebuild_state()
+
+    def history_index(self):
+        """
+        The history index. After a restart, it is built on first use, from the
+        saved checkpoint if it is on the main chain, and the blocks after it.
+        """
+        if self.history is None:
+            history, start = HistoryIndex(), 0
+            saved = self.store.load_meta("history.json") if self.store is not None else None
+            if saved is not None:
+                try:
+                    index, height, blk_hash = HistoryIndex.from_checkpoint(saved)
+                    if height < len(self.headers) and self.headers[height].hash == blk_hash:
+                        history, start = index, height + 1
+                except (ValueError, KeyError, TypeError):
+                    print("The saved history index is malformed. Indexing the chain.")
+            for height in range(start, len(self.headers)):
+                history.add_block(Block.from_parts(self.headers[height], self.get_body(height)), height)
+            self.history = history
+        return self.history
 
     def genesis_block(self):
         """
-        Creates the genesis block, its data is "Genesis Block"
-        and previous_hash is "0". Difficulty is to be set by the user.
+        Creates the genesis block, its only transaction is "Genesis Block"
+        and previous_hash is all zeros. It is mined at the easiest target.
         """
 
         create_time = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-        genesis_block = Block(index=0, timestamp=create_time, transaction="Genesis Block", previous_hash="0",\
-                              signature="Genesis Block", difficulty='easy')
+        genesis_block = Block(index=0, timestamp=create_time, transactions=["Genesis Block"], previous_hash="0" * 64,\
+                              signature="Genesis Block", difficulty=MAX_TARGET)
         genesis_block.mine()
-        self.chain.append(genesis_block)
+        self.append(genesis_block)
+
+    def append(self, block, persist=True):
+        """
+        Seals the block, stores its header and body, indexes it and applies it to the state. No validation.
+        """
+        block.seal()
+        parent_work = self.work[self.parent_hash(block)] if self.headers else 0
+        self.work[block.hash] = parent_work + block_work(block.difficulty)
+        if self.store is not None and persist:
+            self.store.append(encode_block(block))
+            self.header_file.append(encode_stored_header(block.header, self.work[block.hash]))
+        height = len(self.headers)
+        self.hash_index[block.hash] = height
+        self.headers.append(block.header)
+        self.bodies[block.hash] = block.body
+        if self.history is not None:
+            self.history.add_block(block, height)
+            if self.store is not None and persist and height and height % HISTORY_INTERVAL == 0:
+                self.store.save_meta("history.json", self.history.checkpoint(height, block.hash))
+
+        if self.pending_snapshot is None:
+            self.state.apply_block(block.transactions, height)
+            self.state.undo.pop(height - MAX_FORK_DEPTH, None)
+        elif height == self.pending_snapshot[1]:
+            self.adopt_snapshot(block.hash)
+        if height and height % SNAPSHOT_INTERVAL == 0 and self.state.height == height:
+            self.take_snapshot(persist)
+
+        # The body that just left the window is on disk, it can be dropped.
+        if self.body_window is not None and len(self.headers) > self.body_window:
+            self.bodies.pop(self.headers[-1 - self.body_window].hash, None)
+
+    def read_block(self, height:int):
+        """
+        Reads the block at {height} from the store. Decoded straight from the
+        mapped segment, and sealed with its stored hash. Stores written before
+        the binary codec hold json records, they are still read.
+        """
+        with self.store.lock:
+            data = self.store.get(height)
+            if data[:1] == b'{':
+                return Block.deserialize_block(bytes(data).decode())
+            return decode_block(data, trusted=True)[0]
+
+    def load_body(self, height:int):
+        """
+        Reads the body of the block at {height} from the store.
+        """
+        return self.read_block(height).body
+
+    def get_body(self, height:int):
+        """
+        Body of the block at {height}. Recent bodies are in memory, older
+        ones go through the LRU cache.
+        """
+        body = self.bodies.get(self.headers[height].hash)
+        if body is None:
+            body = self.body_cache.get(height)
+        return body
+
+    def cache_stats(self):
+        """
+        Hit and miss counters of the body cache.
+        """
+        return self.body_cache.stats()
+
+    def disconnect_tip(self):
+        """
+        Removes the last block from the main chain (and the store), and reverts its state changes.
+
+        Returns : The removed Block.
+        """
+        height = len(self.headers) - 1
+        block = Block.from_parts(self.headers[height], self.get_body(height))
+        self.headers.pop()
+        del self.hash_index[block.hash]
+        if self.history is not None:
+            self.history.remove_block(height)
+        if self.snapshot is not None and self.snapshot[0] >= height:
+            self.snapshot = None
+        if self.pending_snapshot is None and not self.state.revert_block(height):
+            self.rebuild_state()
+        self.bodies.pop(block.hash, None)
+        self.body_cache.discard(height)
+        if self.store is not None:
+            self.header_file.truncate(height)
+            self.store.truncate(height)
+        self.verified_height = min(self.verified_height, height - 1)
+        return block
+
+    def take_snapshot(self, persist=True):
+        """
+        Snapshot the state at the tip, and save it in the store.
+        """
+        data = self.state.snapshot(self.tip().hash)
+        self.snapshot = (self.state.height, data)
+        if self.store is not None and persist:
+            self.store.save_meta("snapshot.json", data)
+
+    def use_snapshot(self, data:bytes, content_hash:str=None):
+        """
+        Use a snapshot for the state instead of replaying the blocks up to it.
+        It is applied when the block it is tied to is appended, and is ignored
+        if we already are past its height.
+
+        Returns : True if the snapshot will be used.
+        """
+        if content_hash is not None and snapshot_hash(data) != content_hash:
+            print("Received a snapshot that doesn't match its hash.")
+            return False
+        try:
+            state, height, blk_hash = SongState.from_snapshot(data)
+        except (ValueError, KeyError, TypeError):
+            print("Received a malformed snapshot.")
+            return False
+        if height < len(self.headers):
+            return False
+        self.pending_snapshot = (state, height, blk_hash)
+        return True
+
+    def adopt_snapshot(self, blk_hash:str):
+        """
+        The block a pending snapshot is tied to was just appended. Take the
+        state from the snapshot, or replay the chain if the block doesn't match.
+        """
+        state, height, expected = self.pending_snapshot
+        self.pending_snapshot = None
+        if blk_hash == expected:
+            self.state = state
+            self.snapshot = (height, state.snapshot(blk_hash))
+            print(f"State loaded from the snapshot at height {height}, {len(state)} songs.")
+        else:
+            print(f"Snapshot at height {height} is not on our chain. Replaying the chain.")
+            self.rebuild_state()
+
+    def check_pending_snapshot(self):
+        """
+        A pending snapshot above the tip once a sync is over won't be reached. Replay the chain instead.
+        """
+        if self.pending_snapshot is not None and self.pending_snapshot[1] >= len(self.headers):
+            self.rebuild_state()
+
+    def rebuild_state(self):
+        """
+        Replay every block of the main chain into a new state. Only needed
+        when no snapshot or undo record can be used.
+        """
+        self.pending_snapshot = None
+        self.state = SongState()
+        self.replay_state(0)
+
+    def replay_state(self, start:int):
+        """
+        Apply the blocks of the main chain from {start} on to the state.
+        """
+        for height in range(start, len(self.headers)):
+            self.state.apply_block(self.get_body(height).transactions, height)
+            self.state.undo.pop(height - MAX_FORK_DEPTH, None)
+
+    def parent_hash(self, block):
+        """
+        Hash of the parent of a block. Block 1 always hangs off our own genesis
+        block, because the genesis block is local to every peer.
+        """
+        return self.headers[0].hash if block.index == 1 else block.previous_hash
+
+    def reorg(self, tip_hash:str):
+        """
+        Makes the side branch ending at {tip_hash} the main chain. The blocks after
+        the fork point are rolled back into the side tree, and the branch is applied.
+
+        Returns : The blocks rolled back (tip first), and the blocks applied.
+        """
+        branch = []
+        blk_hash = tip_hash
+        while blk_hash in self.side_blocks:
+            block = self.side_blocks[blk_hash]
+            branch.append(block)
+            blk_hash = self.parent_hash(block)
+        branch.reverse()
+        fork_height = self.hash_index[blk_hash]
+        verified = self.verified_height >= fork_height
+
+        rolled_back = []
+        while len(self.headers) - 1 > fork_height:
+            block = self.disconnect_tip()
+            self.side_blocks[block.hash] = block
+            rolled_back.append(block)
+        for block in branch:
+            del self.side_blocks[block.hash]
+            self.append(block)
+
+        # Side blocks were fully checked when they were added to the tree.
+        if verified:
+            self.verified_height = len(self.headers) - 1
+        print(f"Reorg at height {fork_height}: {len(rolled_back)} blocks rolled back, {len(branch)} applied.")
+        return rolled_back, branch
+
+    def prune_side_blocks(self, keep:str=None):
+        """
+        Forget the side branches whose tip is too far below ours to ever
+        matter, however deep they fork. A branch goes from its tip down to
+        the first block another branch still builds on, so no side block is
+        ever left without its parent. The branch of {keep} (the block just
+        added) is kept, it may still be arriving.
+        """
+        min_height = len(self.headers) - 1 - MAX_FORK_DEPTH
+        children = {}   # key: block hash. value: number of side blocks on top of it.
+        for block in self.side_blocks.values():
+            parent_hash = self.parent_hash(block)
+            children[parent_hash] = children.get(parent_hash, 0) + 1
+        stale = [h for h, b in self.side_blocks.items() if h not in children and h != keep and b.index < min_height]
+        for blk_hash in stale:
+            while blk_hash in self.side_blocks and not children.get(blk_hash):
+                block = self.side_blocks.pop(blk_hash)
+                del self.work[blk_hash]
+                blk_hash = self.parent_hash(block)
+                children[blk_hash] -= 1
+
+    def add_branch(self, blocks):
+        """
+        Adds a received chain (genesis excluded) to the block tree. Blocks we
+        already know are skipped. The main chain switches to it if it has more work.
+
+        Returns : The number of new blocks added.
+        """
+        added = 0
+        for block in blocks[self.known_prefix(blocks):]:
+            if self.knows_block(block.hash):
+                continue
+            if not self.add_block(block, block.hash):
+                break
+            added += 1
+        return added
+
+    def known_prefix(self, blocks):
+        """
+        Number of leading blocks of a received chain (genesis excluded) that
+        are already in ours. Compares header fields, no hashing.
+        """
+        known = 0
+        for block in blocks:
+            if block.index != known + 1 or block.index >= len(self.headers):
+                break
+            ours = self.headers[block.index]
+            theirs = block.header
+            if (ours.timestamp, ours.previous_digest, ours.mrkl_digest, ours.difficulty, ours.nonce) != \
+               (theirs.timestamp, theirs.previous_digest, theirs.mrkl_digest, theirs.difficulty, theirs.nonce):
+                break
+            known += 1
+        return known
+
+    def locator(self):
+        """
+        Hashes of main chain blocks, newest first: the last 10 blocks, then
+        blocks twice as far back at every step, down to block 1. The genesis
+        block is local to every peer, so it's never part of it. A peer finds
+        our fork point with the first hash it has on its main chain, even if
+        we went out of sync long ago.
+        """
+        hashes = []
+        height, step = len(self.headers) - 1, 1
+        while height > 1:
+            hashes.append(self.headers[height].hash)
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+        if len(self.headers) > 1:
+            hashes.append(self.headers[1].hash)
+        return hashes
+
+    def headers_after(self, locator, limit:int):
+        """
+        At most {limit} main chain headers after the first block of {locator}
+        that is on our main chain, or after the genesis block if none is.
+        """
+        start = 0
+        for blk_hash in locator:
+            if blk_hash in self.hash_index:
+                start = self.hash_index[blk_hash]
+                break
+        return self.headers[start + 1:start + 1 + limit]
+
+    def check_headers(self, headers, branch=()):
+        """
+        Validates a run of headers received without their bodies (headers-first
+        sync). The first one must extend a block of our main chain, and every
+        one must be right above the one before, at the target derived from the
+        branch, with a timestamp in range, a valid PoW and the hash it claims. Valid headers are sealed.
+        {branch} are headers already checked that {headers} continue, when a
+        fork is deeper than one batch. They are not hashed again.
+
+        Returns : The cumulative work of the branch at its last header, or None if a header is invalid.
+        """
+        first = branch[0][0] if branch else headers[0][0]
+        parent_hash = self.parent_hash(first)
+        if parent_hash not in self.hash_index:
+            return None
+        height = self.hash_index[parent_hash]
+        window = self.headers[max(1, height + 1 - RETARGET_WINDOW):height + 1]
+        work = self.work[parent_hash]
+        for header, blk_hash in branch:
+            window = (window + [header])[-RETARGET_WINDOW:]
+            work += block_work(header.difficulty)
+            parent_hash, height = blk_hash, height + 1
+        digests = self.rehash([header for header, _ in headers])
+        for (header, blk_hash), digest in zip(headers, digests):
+            if header.index != height + 1 or self.parent_hash(header) != parent_hash or digest.hex() != blk_hash \
+               or header.difficulty != retarget(window) or not timestamp_valid(header.timestamp, window) \
+               or not meet_hash_criteria(digest, header.difficulty):
+                return None
+            header.seal(digest)
+            window = (window + [header])[-RETARGET_WINDOW:]
+            work += block_work(header.difficulty)
+            parent_hash, height = blk_hash, height + 1
+        return work
+
+    def has_block(self, blk_hash:str):
+        """
+        Whether the block is already in the chain. O(1).
+        """
+        return blk_hash in self.hash_index
+
+    def knows_block(self, blk_hash:str):
+        """
+        Whether the block is in the chain or in a side branch. O(1).
+        """
+        return blk_hash in self.hash_index or blk_hash in self.side_blocks
+
+    def height_of(self, blk_hash:str):
+        """
+        Height of a known block, on the main chain or a side branch.
+        """
+        if blk_hash in self.hash_index:
+            return self.hash_index[blk_hash]
+        return self.side_blocks[blk_hash].index
+
+    def tip(self):
+        """
+        Header of the last block.
+        """
+        return self.headers[-1]
+
+    def get_block(self, height:int):
+        """
+        Returns the block at {height}, or None.
+        """
+        if 0 <= height < len(self.headers):
+            return Block.from_parts(self.headers[height], self.get_body(height))
+        return None
+
+    def get_block_by_hash(self, blk_hash:str):
+        """
+        Returns the block with hash {blk_hash}, or None. O(1).
+        """
+        height = self.hash_index.get(blk_hash)
+        return None if height is None else self.get_block(height)
+
+    def next_target(self, height=None):
+        """
+        The target a block at {height} (default: the next block) must meet.
+        Derived from the timestamps of the RETARGET_WINDOW blocks before it.
+        The genesis block is local to every peer, so it's never part of the window.
+        """
+        if height is None:
+            height = len(self.headers)
+        window = self.headers[max(1, height - RETARGET_WINDOW):height]
+        return retarget(window)
+
+    def branch_window(self, parent_hash:str):
+        """
+        Headers of the last RETARGET_WINDOW blocks up to {parent_hash} (oldest
+        first, genesis excluded), on whichever branch the parent is.
+        """
+        side = []
+        while parent_hash in self.side_blocks and len(side) < RETARGET_WINDOW:
+            block = self.side_blocks[parent_hash]
+            side.append(block.header)
+            parent_hash = self.parent_hash(block)
+        side.reverse()
+        if len(side) == RETARGET_WINDOW:
+            return side
+        height = self.hash_index[parent_hash] + 1
+        return self.headers[max(1, height - RETARGET_WINDOW + len(side)):height] + side
+
+    def target_after(self, parent_hash:str):
+        """
+        The target a child of {parent_hash} must meet, on whichever branch the parent is.
+        """
+        return retarget(self.branch_window(parent_hash))
+
+    def next_timestamp(self):
+        """
+        Timestamp for a block on top of the tip: now, or just after the median
+        of the blocks before it if our clock is behind it.
+        """
+        now = datetime.now().replace(microsecond=0)
+        median = median_time(self.headers[max(1, len(self.headers) - RETARGET_WINDOW):])
+        if median is not None and now <= median:
+            now = median + timedelta(seconds=1)
+        return now.strftime(TIME_FORMAT)
 
     def add_block(self, block, blk_hash, addr=None):
         """
-        Validates the block and adds it to the chain if it is valid.
+        Validates the block and adds it to the block tree if it is valid.
         This verification process includes:
+            - Checking if the parent is a known block (on any branch)
+            - Checking if the target is the one derived from the branch
+            - Checking if the timestamp is after the median of the blocks before it, and not in the future
             - Checking if the proof is valid
-            - Checking if the previous_hash is correct
+
+        A block on top of the tip extends the main chain. A block on top of
+        any other known block goes to a side branch, which becomes the main
+        chain if it now has more cumulative work (or the same work and a
+        smaller tip hash, so every peer picks the same one).
 
         TODO: Could easily check if the owner is changed. (signature->username)
         """
-        last_block = self.chain[-1]
-        previous_hash = last_block.calc_hash()
+
+        # Check if the block is already known.
+        if self.knows_block(blk_hash):
+            print("Block already in the chain.")
+            return False
+
+        parent_hash = self.parent_hash(block)
+        digest = block.calc_digest()
 
         # Check if the signature is valid.
         if addr and block.signature != sha256(addr.encode('utf-8')).hexdigest():
@@ -37,39 +639,164 @@ class Blockchain:
             return False
 
         # Check if the block has been tampered.
-        elif blk_hash != block.calc_hash():
+        elif blk_hash != digest.hex() or not block.check_mrkl_root():
             print("Received a tampered block.")
             return False
 
-        # Check if the previous hash match
-        elif previous_hash != block.previous_hash and last_block.data != "Genesis Block":
+        # Check if we know the parent.
+        elif not self.knows_block(parent_hash):
             print("Received a block but the previous hash didn't match.")
             return False
 
+        # Check if the block is right above its parent.
+        elif block.index != self.height_of(parent_hash) + 1:
+            print("Received a block at an unexpected height.")
+            return False
+
+        # Check if the block was mined at the right difficulty.
+        elif block.difficulty != self.target_after(parent_hash):
+            print("Received a block with an unexpected target.")
+            return False
+
+        # Check if the timestamp is in range, it drives the target of the next blocks.
+        elif not timestamp_valid(block.timestamp, self.branch_window(parent_hash)):
+            print("Received a block with an invalid timestamp.")
+            return False
+
         # Check if the PoW is valid.
-        elif not meet_hash_criteria(block.hash, block.difficulty):
+        elif not meet_hash_criteria(digest, block.difficulty):
             print("Received a block with invalid PoW.")
             return False
 
-        # Check if the block is already in the chain.
-        for b in self.chain:
-            if b.calc_hash() == block.calc_hash():
-                print("Block already in the chain.")
-                return False
+        if parent_hash == self.tip().hash:
+            self.append(block)
+            if self.verified_height == len(self.headers) - 2:
+                self.verified_height += 1
+            self.prune_side_blocks()
+            self.connected.append(block)
+            return True
 
-        self.chain.append(block)
+        block.seal()
+        self.side_blocks[blk_hash] = block
+        work = self.work[parent_hash] + block_work(block.difficulty)
+        self.work[blk_hash] = work
+        tip_work = self.work[self.tip().hash]
+        print(f"Block {block.index} added to a side branch.")
 
+        if work > tip_work or (work == tip_work and blk_hash < self.tip().hash):
+            rolled_back, applied = self.reorg(blk_hash)
+            self.disconnected += rolled_back
+            self.connected += applied
+        self.prune_side_blocks(blk_hash)
         return True
 
-    def is_chain_valid(self):
+    def take_changes(self):
         """
-        Checks if the entire blockchain is valid.
+        The blocks add_block() disconnected from and connected to the main chain
+        since the last call, in that order. A block can be in both lists.
+
+        Returns : (disconnected blocks, connected blocks)
         """
-        for i in range(1, len(self.chain)):
-            curr = self.chain[i]
-            prev = self.chain[i - 1]
-            if curr.hash != curr.calc_hash():
-                return False
-            if curr.previous_hash != prev.calc_hash():
+        changes = self.disconnected, self.connected
+        self.disconnected, self.connected = [], []
+        return changes
+
+    def get_transactions(self, refs):
+        """
+        Resolve (height, position) references to (height, transaction dict).
+        """
+        return [(height, json.loads(self.get_body(height).transactions[position])) for height, position in refs]
+
+    def songs_by_artist(self, artist:str, limit:int=20, cursor=None):
+        """
+        Transactions registering, sending or receiving a song by {artist}, newest first.
+
+        Returns : ([(height, transaction)], cursor of the next page or None)
+        """
+        refs, cursor = page(self.history_index().by_artist.get(artist, []), limit, cursor)
+        return self.get_transactions(refs), cursor
+
+    def song_history(self, song_hash:str, limit:int=20, cursor=None):
+        """
+        Registration and transfers of the song with hash {song_hash}, newest first.
+
+        Returns : ([(height, transaction)], cursor of the next page or None)
+        """
+        refs, cursor = page(self.history_index().by_song.get(song_hash, []), limit, cursor)
+        return self.get_transactions(refs), cursor
+
+    def blocks_by_signer(self, signer:str, limit:int=20, cursor=None):
+        """
+        Headers of the blocks signed by {signer}, newest first.
+
+        Returns : ([BlockHeader], cursor of the next page or None)
+        """
+        heights, cursor = page(self.history_index().by_signer.get(signer, []), limit, cursor)
+        return [self.headers[h] for h in heights], cursor
+
+    def blocks_between(self, start=None, end=None, limit:int=20, cursor=None):
+        """
+        Headers of the blocks with a timestamp between {start} and {end}
+        (datetimes or block timestamp strings, inclusive), newest first.
+
+        Returns : ([BlockHeader], cursor of the next page or None)
+        """
+        lo, hi = time_range(self.history_index().by_time, start, end)
+        items, cursor = page(self.history.by_time, limit, cursor, lo, hi)
+        return [self.headers[h] for _, h in items], cursor
+
+    def get_ts_proof(self, ts_hash:str):
+        """
+        Finds the transaction with sha256 hash {ts_hash} in the chain, through the history index.
+
+        Returns : (header of the block containing it, merkle proof), or None if it's not on chain.
+        """
+        ref = self.history_index().by_ts.get(ts_hash)
+        if ref is None:
+            return None
+        height, position = ref
+        block = self.get_block(height)
+        return block.serialize_header(), block.mrkl_proof(position)
+
+    def check_ts_proof(self, ts_hash:str, proof:list, header:dict):
+        """
+        Checks a merkle proof of a transaction with the header of its block
+        (see verify_ts_proof()). A header only proves the target it claims,
+        which anyone can pick easy enough to forge one. So its block must also
+        be on our main chain, at the target derived from the chain.
+
+        Returns : True if the transaction is in a block of our main chain.
+        """
+        height = self.hash_index.get(header['hash'])
+        if not height or int(header['index']) != height or int(header['difficulty']) != self.next_target(height):
+            return False
+        return verify_ts_proof(ts_hash, proof, header)
+
+    def rehash(self, headers):
+        """
+        Raw digests of {headers}, computed again. Long runs go to the validation pool.
+        """
+        if len(headers) >= PARALLEL_THRESHOLD and self.validation_pool is None:
+            self.validation_pool = make_pool()
+        return hash_headers(headers, self.validation_pool)
+
+    def is_chain_valid(self, full=False):
+        """
+        Checks if the blockchain is valid. Only the blocks after the last
+        verified height are checked, unless {full} is set. Headers are hashed
+        again (see rehash()), so a stored hash that doesn't match its header
+        is caught. On failure, the verified height is the last valid block.
+        """
+        start = 1 if full else self.verified_height + 1
+        digests = self.rehash(self.headers[start:])
+        for i in range(start, len(self.headers)):
+            curr = self.headers[i]
+            prev = self.headers[i - 1]
+            digest = digests[i - start]
+            # Block 1 links to the genesis block of whoever mined it, which is local to every peer.
+            if digest != curr.digest or curr.difficulty != self.next_target(i) \
+               or not meet_hash_criteria(digest, curr.difficulty) or (i > 1 and curr.previous_digest != prev.digest):
+                self.verified_height = i - 1
                 return False
-        return True
\ No newline at end of file
+        self.verified_height = len(self.headers) - 1
+        return True
@@ -0,0 +1,69 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Seconds a broadcast waits for each peer before reporting it as failed.
+BROADCAST_DEADLINE = 2.0
+
+# Peers sent to at the same time.
+BROADCAST_WORKERS = 16
+
+
+class Broadcaster:
+    '''
+    Sends one message to many peers at once, over the connection pool. Every
+    peer gets the same deadline, counted from the start of the broadcast, so
+    an unreachable or slow peer only delays itself and a broadcast never
+    takes much longer than {deadline}, whatever the number of peers. At most
+    {workers} peers are sent to at the same time.
+    '''
+
+    def __init__(self, pool, deadline:float=BROADCAST_DEADLINE, workers:int=BROADCAST_WORKERS):
+        self.pool = pool
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='broadcast')
+
+    def broadcast(self, peers, msg_type:int, payload=b"", deadline:float=None):
+        '''
+        Send one frame to every peer of {peers}.
+
+        Returns : {peer: (delivered, seconds from the start of the broadcast)}
+        '''
+        deadline = self.deadline if deadline is None else deadline
+        start = time.time()
+        expires = start + deadline
+        futures = {self.executor.submit(self.deliver, peer, msg_type, payload, expires): peer for peer in peers}
+        # The sends give up by themselves at the deadline, the margin is for the threads to report it.
+        wait(futures, timeout=deadline + 0.5)
+
+        results = {}
+        for future, peer in futures.items():
+            if future.done():
+                sent, finished = future.result()
+                results[peer] = (sent, finished - start)
+            else:
+                results[peer] = (False, time.time() - start)
+        return results
+
+    def post(self, peers, msg_type:int, payload=b"", done=None, deadline:float=None):
+        '''
+        Like broadcast(), but returns right away. done(peer, delivered, seconds
+        from the start of the broadcast) is called as each send finishes.
+        '''
+        deadline = self.deadline if deadline is None else deadline
+        start = time.time()
+        expires = start + deadline
+        for peer in peers:
+            future = self.executor.submit(self.deliver, peer, msg_type, payload, expires)
+            if done is not None:
+                future.add_done_callback(lambda f, peer=peer: f.cancelled() or done(peer, f.result()[0], f.result()[1] - start))
+
+    def deliver(self, peer:str, msg_type:int, payload, expires:float):
+        '''
+        Returns : (delivered, time it was done)
+        '''
+        left = expires - time.time()
+        sent = left > 0 and self.pool.send(peer, msg_type, payload, timeout=left)
+        return sent, time.time()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
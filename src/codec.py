@@ -0,0 +1,245 @@
+import calendar
+import time
+from struct import Struct, error as StructError
+from block import Block, BlockHeader, BlockBody
+
+# Version of the encoding, first byte of every encoded block and transaction.
+CODEC_VERSION = 1
+
+# Format of block timestamps. They are packed as seconds since the epoch.
+TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+MIN_TIME = calendar.timegm((1, 1, 1, 0, 0, 0))
+MAX_TIME = calendar.timegm((9999, 12, 31, 23, 59, 59))
+
+# Block layout :
+#   header : [version (1)][index (4)][timestamp (8)][previous hash (32)][merkle root (32)]
+#            [target (32)][nonce (8)][hash (32)]
+#   body   : [length (4)] then [mine time (8)][signature (2 + n)][count (4)][transaction (4 + n)]*
+BLOCK_HEADER = Struct('>BIq32s32s32sQ32s')
+# Header in the headers file of a store : the encoded header, then [cumulative work (32)]
+STORED_HEADER = Struct('>BIq32s32s32sQ32s32s')
+BODY_LENGTH = Struct('>I')
+BODY_PREFIX = Struct('>d')
+SHORT_LENGTH = Struct('>H')
+LONG_LENGTH = Struct('>I')
+
+# Transaction layout : [version (1)][type (1)] then 6 fields [length (2)][utf-8 (n)]
+TS_PREFIX = Struct('>BB')
+TS_TYPES = ('Register', 'Transfer')
+TS_FIELDS = ('user_name', 'timestamp', 'song_name', 'song_hash', 'signature', 'other_user')
+
+
+class CodecError(ValueError):
+    '''
+    Raised when a buffer doesn't hold a valid encoding.
+    '''
+
+
+def pack_time(timestamp:str):
+    return calendar.timegm(time.strptime(timestamp, TIME_FORMAT))
+
+
+def unpack_time(seconds:int):
+    '''
+    Raises CodecError if {seconds} is out of the range of a timestamp (year 1 to 9999).
+    '''
+    try:
+        if not MIN_TIME <= seconds <= MAX_TIME:
+            raise ValueError(f"{seconds} is out of range")
+        return time.strftime(TIME_FORMAT, time.gmtime(seconds))
+    except (OSError, OverflowError, ValueError) as e:
+        raise CodecError(f"Malformed block timestamp : {e}")
+
+
+def encode_block(block):
+    '''
+    Binary encoding of a block, for the wire and the store.
+    '''
+    body = [BODY_PREFIX.pack(float(block.mine_time))]
+    signature = block.signature.encode()
+    body.append(SHORT_LENGTH.pack(len(signature)) + signature)
+    body.append(LONG_LENGTH.pack(len(block.transactions)))
+    for ts in block.transactions:
+        ts = ts.encode()
+        body.append(LONG_LENGTH.pack(len(ts)) + ts)
+    body = b"".join(body)
+
+    return encode_header(block.header) + BODY_LENGTH.pack(len(body)) + body
+
+
+def encode_header(header):
+    '''
+    Binary encoding of a BlockHeader with its hash, the first part of encode_block().
+    '''
+    return BLOCK_HEADER.pack(CODEC_VERSION, header.index, pack_time(header.timestamp),
+                             header.previous_digest, header.mrkl_digest,
+                             header.difficulty.to_bytes(32, 'big'), header.nonce, header.calc_digest())
+
+
+def decode_header(buf, offset:int=0):
+    '''
+    Decode a header encoded by encode_header(). The header is not sealed, the
+    caller checks the hash.
+
+    Returns : (BlockHeader, raw digest it claims)
+    '''
+    try:
+        version, index, seconds, previous_hash, mrkl_root, target, nonce, digest = BLOCK_HEADER.unpack_from(buf, offset)
+    except StructError as e:
+        raise CodecError(f"Malformed block header : {e}")
+    if version != CODEC_VERSION:
+        raise CodecError(f"Unknown block encoding version {version}.")
+    header = BlockHeader(index, unpack_time(seconds), previous_hash, mrkl_root, int.from_bytes(target, 'big'), nonce)
+    return header, digest
+
+
+def encode_headers(headers):
+    '''
+    Encoding of a list of headers: the encoded headers back to back.
+    '''
+    return b"".join(encode_header(h) for h in headers)
+
+
+def decode_headers(buf):
+    '''
+    Decode a list of headers encoded by encode_headers().
+
+    Returns : [(BlockHeader, hash)]
+    '''
+    if len(buf) % BLOCK_HEADER.size:
+        raise CodecError(f"Malformed header list of {len(buf)} bytes.")
+    headers = []
+    for offset in range(0, len(buf), BLOCK_HEADER.size):
+        header, digest = decode_header(buf, offset)
+        headers.append((header, digest.hex()))
+    return headers
+
+
+def encode_stored_header(header, work:int):
+    '''
+    Record of the headers file of a store: a header, with its hash and the
+    cumulative work of the chain up to it.
+    '''
+    return encode_header(header) + work.to_bytes(32, 'big')
+
+
+def decode_stored_headers(buf):
+    '''
+    Decode the records written by encode_stored_header(), back to back.
+
+    Returns : [(BlockHeader, raw digest, cumulative work)]
+    '''
+    if len(buf) % STORED_HEADER.size:
+        raise CodecError(f"Malformed header file of {len(buf)} bytes.")
+    headers = []
+    for version, index, seconds, previous_hash, mrkl_root, target, nonce, digest, work in STORED_HEADER.iter_unpack(buf):
+        if version != CODEC_VERSION:
+            raise CodecError(f"Unknown block encoding version {version}.")
+        header = BlockHeader(index, unpack_time(seconds), previous_hash, mrkl_root, int.from_bytes(target, 'big'), nonce)
+        headers.append((header, digest, int.from_bytes(work, 'big')))
+    return headers
+
+
+def decode_block(buf, offset:int=0, trusted:bool=False):
+    '''
+    Decode a block encoded by encode_block() from a bytes-like object (e.g. a
+    memoryview on a received message or a mapped segment), without copying it.
+
+    The header is sealed with the stored hash only if {trusted} (our own
+    store). Otherwise the caller checks it, along with the merkle root.
+
+    Returns : (Block, hash, offset right after the block)
+    '''
+    buf = memoryview(buf)
+    header, digest = decode_header(buf, offset)
+    offset += BLOCK_HEADER.size
+    try:
+        length, = BODY_LENGTH.unpack_from(buf, offset)
+        offset += BODY_LENGTH.size
+        end = offset + length
+        if end > len(buf):
+            raise CodecError("Truncated block.")
+
+        mine_time, = BODY_PREFIX.unpack_from(buf, offset)
+        offset += BODY_PREFIX.size
+        size, = SHORT_LENGTH.unpack_from(buf, offset)
+        offset += SHORT_LENGTH.size
+        signature = str(buf[offset:offset + size], 'utf-8')
+        offset += size
+        count, = LONG_LENGTH.unpack_from(buf, offset)
+        offset += LONG_LENGTH.size
+        transactions = []
+        for _ in range(count):
+            size, = LONG_LENGTH.unpack_from(buf, offset)
+            offset += LONG_LENGTH.size
+            transactions.append(str(buf[offset:offset + size], 'utf-8'))
+            offset += size
+    except (StructError, UnicodeDecodeError) as e:
+        raise CodecError(f"Malformed block : {e}")
+    if offset != end:
+        raise CodecError("Block body length doesn't match its content.")
+
+    if trusted:
+        header.seal(digest)
+    body = BlockBody(transactions, signature, mine_time)
+    return Block.from_parts(header, body), digest.hex(), end
+
+
+def encode_blocks(blocks):
+    '''
+    Encoding of a list of blocks: the encoded blocks back to back.
+    '''
+    return b"".join(encode_block(b) for b in blocks)
+
+
+def decode_blocks(buf):
+    '''
+    Decode a list of blocks encoded by encode_blocks().
+
+    Returns : [(Block, hash)]
+    '''
+    buf = memoryview(buf)
+    blocks = []
+    offset = 0
+    while offset < len(buf):
+        block, blk_hash, offset = decode_block(buf, offset)
+        blocks.append((block, blk_hash))
+    return blocks
+
+
+def encode_transaction(ts):
+    '''
+    Binary encoding of a Transaction for the wire.
+    '''
+    fields = [TS_PREFIX.pack(CODEC_VERSION, TS_TYPES.index(ts.transaction_type))]
+    for name in TS_FIELDS:
+        value = (getattr(ts, name, None) or '').encode()
+        fields.append(SHORT_LENGTH.pack(len(value)) + value)
+    return b"".join(fields)
+
+
+def decode_transaction(buf):
+    '''
+    Decode a transaction encoded by encode_transaction().
+
+    Returns : The transaction fields as a dict, like the json of serialize_transaction().
+    '''
+    buf = memoryview(buf)
+    try:
+        version, ts_type = TS_PREFIX.unpack_from(buf, 0)
+        if version != CODEC_VERSION:
+            raise CodecError(f"Unknown transaction encoding version {version}.")
+        ts = {'transaction_type': TS_TYPES[ts_type]}
+        offset = TS_PREFIX.size
+        for name in TS_FIELDS:
+            size, = SHORT_LENGTH.unpack_from(buf, offset)
+            offset += SHORT_LENGTH.size
+            ts[name] = str(buf[offset:offset + size], 'utf-8')
+            offset += size
+    except (StructError, UnicodeDecodeError, IndexError) as e:
+        raise CodecError(f"Malformed transaction : {e}")
+    if not ts['other_user']:
+        if ts['transaction_type'] == 'Transfer':
+            raise CodecError("Malformed transaction : a transfer without its receiver.")
+        del ts['other_user']
+    return ts
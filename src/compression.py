@@ -0,0 +1,97 @@
+import zlib
+import lzma
+from codec import CodecError
+from protocol import MAX_FRAME
+
+# Codecs a peer can offer, most preferred first.
+CODECS = ('zlib', 'lzma')
+
+# Frames smaller than this are sent as they are, compressing them doesn't pay off.
+COMPRESS_THRESHOLD = 256
+
+
+def negotiate(offered, accepted):
+    '''
+    The first codec of {accepted} (the receiver's preference) that is also
+    in {offered}, or None to send uncompressed.
+    '''
+    for codec in accepted:
+        if codec in offered and codec in CODECS:
+            return codec
+    return None
+
+
+class Compressor:
+    '''
+    Compresses the frames of one stream. zlib keeps its window from one frame
+    to the next and flushes at every frame boundary, so every frame can be
+    decompressed as soon as it arrives while the field names, signers and
+    song metadata repeated from block to block still compress. lzma can't
+    flush mid-stream, so every frame is a raw lzma2 chunk of its own.
+    '''
+
+    def __init__(self, codec:str, level:int=6):
+        self.codec = codec
+        self.level = level
+        if codec == 'zlib':
+            self.zlib = zlib.compressobj(level)
+
+    def compress(self, data):
+        if self.codec == 'zlib':
+            return self.zlib.compress(data) + self.zlib.flush(zlib.Z_SYNC_FLUSH)
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2, 'preset': self.level}])
+
+
+class Decompressor:
+    '''
+    Decompresses the frames made by a Compressor of the same codec, in order.
+    A frame that decompresses to more than {max_length} bytes is rejected
+    without being inflated any further.
+    '''
+
+    def __init__(self, codec:str, max_length:int=MAX_FRAME):
+        self.codec = codec
+        self.max_length = max_length
+        if codec == 'zlib':
+            self.zlib = zlib.decompressobj()
+
+    def decompress(self, data):
+        if self.codec == 'zlib':
+            out = self.zlib.decompress(data, self.max_length)
+            too_long = bool(self.zlib.unconsumed_tail)
+        else:
+            lzma_frame = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2}])
+            out = lzma_frame.decompress(data, self.max_length)
+            too_long = not lzma_frame.eof and not lzma_frame.needs_input
+        if too_long:
+            raise CodecError(f"Compressed frame of {len(data)} bytes inflates past {self.max_length} bytes.")
+        return out
+
+
+class CompressionStats:
+    '''
+    Bytes before and after compression of the bulk transfers, per direction.
+    '''
+
+    def __init__(self):
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.recv_raw = 0
+        self.recv_wire = 0
+
+    def sent(self, raw:int, wire:int):
+        self.sent_raw += raw
+        self.sent_wire += wire
+
+    def received(self, raw:int, wire:int):
+        self.recv_raw += raw
+        self.recv_wire += wire
+
+    def stats(self):
+        '''
+        Returns : The counters, with the compression ratio (raw / wire) of each direction.
+        '''
+        return {'sent_raw': self.sent_raw, 'sent_wire': self.sent_wire,
+                'sent_ratio': round(self.sent_raw / self.sent_wire, 2) if self.sent_wire else 1.0,
+                'recv_raw': self.recv_raw, 'recv_wire': self.recv_wire,
+                'recv_ratio': round(self.recv_raw / self.recv_wire, 2) if self.recv_wire else 1.0}
@@ -0,0 +1,142 @@
+import json
+from hashlib import sha256
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+
+# Format of block timestamps.
+TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+
+class HistoryIndex:
+    '''
+    Secondary indexes over the main chain, maintained as blocks are appended
+    and rolled back.
+
+    Transactions are referenced by (height, position in the block) and blocks
+    by height. Every posting list is sorted, so a page of results is found
+    with a binary search instead of a walk over the chain. Blocks are only
+    ever appended to or removed from the tip, so the postings of the tip are
+    always at the end of their lists.
+    '''
+
+    def __init__(self):
+        self.by_artist = {}     # key: user name. value: [(height, position)] of the transactions involving the user.
+        self.by_song = {}       # key: song hash. value: [(height, position)] of the transactions of the song.
+        self.by_signer = {}     # key: block signature. value: [height]
+        self.by_time = []       # [(timestamp in seconds, height)], sorted.
+        self.by_ts = {}         # key: sha256 hash of a transaction. value: (height, position), the newest one.
+        self.keys = {}          # key: height. value: (artists, songs, signer, timestamp, transaction hashes) to remove the block.
+
+    def add_block(self, block, height:int):
+        artists, songs, ts_hashes = set(), set(), []
+        for position, ts in enumerate(block.transactions):
+            ts_hash = sha256(ts.encode()).hexdigest()
+            self.by_ts[ts_hash] = (height, position)
+            ts_hashes.append(ts_hash)
+            try:
+                ts = json.loads(ts)
+                users = {ts['user_name'], ts.get('other_user')}
+                song_hash = ts['song_hash']
+            except (ValueError, TypeError, KeyError):
+                continue    # e.g. the genesis block.
+            for user in users:
+                if user:
+                    self.by_artist.setdefault(user, []).append((height, position))
+                    artists.add(user)
+            self.by_song.setdefault(song_hash, []).append((height, position))
+            songs.add(song_hash)
+
+        self.by_signer.setdefault(block.signature, []).append(height)
+        timestamp = parse_time(block.timestamp)
+        insort(self.by_time, (timestamp, height))
+        self.keys[height] = (artists, songs, block.signature, timestamp, ts_hashes)
+
+    def remove_block(self, height:int):
+        '''
+        Drop the postings of the block at {height}, which must be the tip.
+        '''
+        artists, songs, signer, timestamp, ts_hashes = self.keys.pop(height)
+        for ts_hash in ts_hashes:
+            if self.by_ts.get(ts_hash, (None,))[0] == height:
+                del self.by_ts[ts_hash]
+        for index, keys in ((self.by_artist, artists), (self.by_song, songs)):
+            for key in keys:
+                postings = index[key]
+                while postings and postings[-1][0] == height:
+                    postings.pop()
+                if not postings:
+                    del index[key]
+        self.by_signer[signer].pop()
+        if not self.by_signer[signer]:
+            del self.by_signer[signer]
+        del self.by_time[bisect_left(self.by_time, (timestamp, height))]
+
+    def checkpoint(self, height:int, block_hash:str):
+        '''
+        Export the index as of the block at {height}, whose hash is {block_hash}.
+
+        Returns : The checkpoint, as JSON bytes.
+        '''
+        data = {
+            'height':       height,
+            'block_hash':   block_hash,
+            'by_artist':    self.by_artist,
+            'by_song':      self.by_song,
+            'by_signer':    self.by_signer,
+            'by_time':      self.by_time,
+            'by_ts':        self.by_ts,
+            'keys':         [[h, sorted(artists), sorted(songs), signer, timestamp, ts_hashes]
+                             for h, (artists, songs, signer, timestamp, ts_hashes) in self.keys.items()]
+        }
+        return json.dumps(data, separators=(',', ':')).encode()
+
+    @classmethod
+    def from_checkpoint(cls, data:bytes):
+        '''
+        Rebuild an index from a checkpoint.
+
+        Returns : (index, height, block hash)
+        '''
+        data = json.loads(data)
+        index = cls()
+        index.by_artist = {user: [tuple(p) for p in postings] for user, postings in data['by_artist'].items()}
+        index.by_song = {song: [tuple(p) for p in postings] for song, postings in data['by_song'].items()}
+        index.by_signer = data['by_signer']
+        index.by_time = [tuple(p) for p in data['by_time']]
+        index.by_ts = {ts_hash: tuple(p) for ts_hash, p in data['by_ts'].items()}
+        index.keys = {h: (set(artists), set(songs), signer, timestamp, ts_hashes)
+                      for h, artists, songs, signer, timestamp, ts_hashes in data['keys']}
+        return index, data['height'], data['block_hash']
+
+
+def parse_time(timestamp):
+    '''
+    Block timestamp (string or datetime) to seconds.
+    '''
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, TIME_FORMAT)
+    return timestamp.timestamp()
+
+
+def page(postings, limit:int, cursor=None, lo:int=0, hi:int=None):
+    '''
+    One page of a sorted posting list, newest first. Only postings[lo:hi] are
+    considered. {cursor} is the value returned by the previous page.
+
+    Returns : (items, cursor of the next page or None)
+    '''
+    hi = len(postings) if hi is None else hi
+    if cursor is not None:
+        hi = min(hi, bisect_left(postings, cursor, lo, hi))
+    start = max(lo, hi - limit)
+    items = postings[start:hi][::-1]
+    return items, (postings[start] if start > lo else None)
+
+
+def time_range(postings, start, end):
+    '''
+    Bounds of the entries of the time index between {start} and {end} (inclusive).
+    '''
+    lo = 0 if start is None else bisect_left(postings, (parse_time(start),))
+    hi = len(postings) if end is None else bisect_right(postings, (parse_time(end), float('inf')))
+    return lo, hi
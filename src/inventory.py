@@ -0,0 +1,112 @@
+import time
+from hashlib import sha256
+from struct import Struct, error as StructError
+from threading import Lock
+from collections import OrderedDict
+from codec import CodecError
+
+# Kinds of inventory items.
+INV_BLOCK = 1
+INV_TX = 2
+
+# INV and GET_DATA layout : [kind (1)][hash (32)]*
+INV_ITEM = Struct('>B32s')
+
+# Items in one INV or GET_DATA message, at most.
+MAX_INV_ITEMS = 1000
+
+# Hashes of the transactions we have seen (in the pool or mined), at most.
+SEEN_LIMIT = 100000
+
+# Seconds before an item we asked for, but never got, can be asked from another peer.
+REQUEST_TIMEOUT = 10
+
+
+def encode_inv(items):
+    '''
+    Encoding of [(kind, hash)] for INV and GET_DATA messages.
+    '''
+    return b"".join(INV_ITEM.pack(kind, bytes.fromhex(item_hash)) for kind, item_hash in items)
+
+
+def decode_inv(buf):
+    '''
+    Returns : [(kind, hash)] of an INV or GET_DATA message.
+    '''
+    if len(buf) % INV_ITEM.size or len(buf) // INV_ITEM.size > MAX_INV_ITEMS:
+        raise CodecError(f"Malformed inventory of {len(buf)} bytes.")
+    try:
+        items = [(kind, item_hash.hex()) for kind, item_hash in INV_ITEM.iter_unpack(buf)]
+    except StructError as e:
+        raise CodecError(f"Malformed inventory : {e}")
+    for kind, _ in items:
+        if kind not in (INV_BLOCK, INV_TX):
+            raise CodecError(f"Unknown inventory kind {kind}.")
+    return items
+
+
+def ts_hash(ts):
+    '''
+    Hash of a Transaction, as used for merkle proofs and inventories. {ts} is
+    a Transaction or its serialization (as in the transactions of a block).
+    '''
+    if not isinstance(ts, str):
+        ts = ts.serialize_transaction()
+    return sha256(ts.encode()).hexdigest()
+
+
+class Inventory:
+    '''
+    What a peer knows for the INV/GETDATA gossip. Peers announce the hashes of
+    new blocks and transactions, and only the announced items we don't have
+    are fetched, once: an item asked from one peer isn't asked from another
+    one for REQUEST_TIMEOUT seconds. Blocks are checked against the block
+    tree by the caller. Transactions are checked against the hashes seen
+    here, which cover the transaction pool and the recently mined ones.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.seen_ts = OrderedDict()    # key: transaction hash. value: None. Oldest first.
+        self.requested = {}             # key: item hash. value: time the request expires.
+
+    def add_ts(self, item_hash:str):
+        '''
+        Mark a transaction as seen. Returns False if it already was.
+        '''
+        with self.lock:
+            self.requested.pop(item_hash, None)
+            if item_hash in self.seen_ts:
+                return False
+            self.seen_ts[item_hash] = None
+            if len(self.seen_ts) > SEEN_LIMIT:
+                self.seen_ts.popitem(last=False)
+            return True
+
+    def has_ts(self, item_hash:str):
+        return item_hash in self.seen_ts
+
+    def received(self, item_hash:str):
+        '''
+        An item we asked for arrived (or turned out to be invalid).
+        '''
+        with self.lock:
+            self.requested.pop(item_hash, None)
+
+    def want(self, items, have):
+        '''
+        The announced {items} to ask for: the ones have(kind, hash) says we
+        don't have and that aren't already asked for. They count as asked for.
+        '''
+        now = time.time()
+        wanted = []
+        with self.lock:
+            for kind, item_hash in items:
+                if have(kind, item_hash) or self.requested.get(item_hash, 0) > now:
+                    continue
+                self.requested[item_hash] = now + REQUEST_TIMEOUT
+                wanted.append((kind, item_hash))
+            # Forget the requests that expired.
+            if len(self.requested) > MAX_INV_ITEMS:
+                self.requested = {h: t for h, t in self.requested.items() if t > now}
+        return wanted
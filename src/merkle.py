@@ -0,0 +1,93 @@
+from hashlib import sha256
+
+
+class MerkleTree:
+    '''
+    Merkle tree over raw 32-byte hashes, built level by level.
+
+    levels[0] holds the leaves and levels[-1] holds only the root. When a level
+    has an odd number of nodes, the last one is paired with itself. All the
+    levels are kept, so appending or updating a leaf only rehashes its path
+    to the root: O(log n).
+    '''
+
+    def __init__(self, leaves=()):
+        self.levels = [list(leaves)]
+        level = self.levels[0]
+        while len(level) > 1:
+            level = [sha256(level[i] + (level[i+1] if i + 1 < len(level) else level[i])).digest()
+                     for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        '''
+        Returns : The raw merkle root, or None if the tree is empty.
+        '''
+        if not self.levels[0]:
+            return None
+        return self.levels[-1][0]
+
+    def append(self, leaf:bytes):
+        '''
+        Add a leaf at the end of the tree.
+        '''
+        self.levels[0].append(leaf)
+        self._rehash_path(len(self.levels[0]) - 1)
+
+    def update(self, index:int, leaf:bytes):
+        '''
+        Replace the {index}-th leaf.
+        '''
+        self.levels[0][index] = leaf
+        self._rehash_path(index)
+
+    def proof(self, index:int):
+        '''
+        Merkle inclusion proof of the {index}-th leaf. Every step is
+        (sibling, is_left), from the leaf up to the root.
+        '''
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling >= len(level):
+                sibling = index
+            proof.append((level[sibling], sibling < index))
+            index //= 2
+        return proof
+
+    def _rehash_path(self, index:int):
+        '''
+        Recompute the parents of the {index}-th leaf up to the root.
+        '''
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            left = index & ~1
+            right = left + 1 if left + 1 < len(level) else left
+            parent = sha256(level[left] + level[right]).digest()
+
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            upper = self.levels[depth + 1]
+            index //= 2
+            if index < len(upper):
+                upper[index] = parent
+            else:
+                upper.append(parent)
+            depth += 1
+
+
+def verify_proof(leaf:bytes, proof, root:bytes):
+    '''
+    Checks that a leaf is included under a merkle root.
+    '''
+    node = leaf
+    for sibling, is_left in proof:
+        if is_left:
+            node = sha256(sibling + node).digest()
+        else:
+            node = sha256(node + sibling).digest()
+    return node == root
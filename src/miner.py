@@ -0,0 +1,106 @@
+import os
+import time
+import multiprocessing as mp
+from hashlib import sha256
+from utils import target_bytes, find_nonce, CHECK_INTERVAL
+
+# How often (seconds) the parent checks the cancel flag while workers search.
+POLL_INTERVAL = 0.002
+
+_stop = None
+
+
+def _init_worker(stop):
+    '''
+    Runs once in every worker process. Keeps a handle on the shared stop flag.
+    '''
+    global _stop
+    _stop = stop
+
+
+def _search(job):
+    '''
+    Worker loop. Tries nonces start, start + step, start + 2*step, ... until one
+    of them meets the target, or another worker sets the stop flag.
+
+    Returns : (nonce or None, number of hashes tried)
+    '''
+    prefix, target, start, step = job
+    midstate = sha256(prefix)
+    nonce = start
+    tried = 0
+    while not _stop.is_set():
+        found = find_nonce(midstate, target, nonce, step, CHECK_INTERVAL)
+        if found is not None:
+            return found, tried + (found - nonce) // step + 1
+        nonce += CHECK_INTERVAL * step
+        tried += CHECK_INTERVAL
+    return None, tried
+
+
+class Miner:
+    '''
+    Parallel Proof of Work. The nonce space is interleaved over a pool of
+    worker processes: worker i tries nonce + i, nonce + i + workers, ...
+    The first worker that finds a valid nonce wins and all others stop at
+    their next check of the shared stop flag. The workers are started by a
+    fork server, so a Miner can be made while the peer already runs threads.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        context = mp.get_context('forkserver')
+        self.stop = context.Event()
+        self.pool = context.Pool(self.workers, initializer=_init_worker, initargs=(self.stop,))
+        self.hashes = 0     # Hashes tried during the last search, summed over all workers.
+        self.hash_rate = 0  # Aggregate hashes per second of the last search.
+
+    def mine(self, block, cancel=None):
+        '''
+        Find a nonce for the block. On return block.nonce is set to the nonce
+        of the first worker to finish. It meets the target, but it isn't always
+        the one the serial Block.mine() would find: that is the smallest one.
+        If the cancel event is set during the search, all workers are stopped.
+
+        Returns : True if a nonce was found, False if the search was cancelled.
+        '''
+        self.stop.clear()
+        prefix = block.header_prefix()
+        target = target_bytes(block.difficulty)
+        nonce = int(block.nonce)
+        jobs = [(prefix, target, nonce + i, self.workers) for i in range(self.workers)]
+
+        start_time = time.time()
+        found = None
+        cancelled = False
+        hashes = 0
+        results = self.pool.imap_unordered(_search, jobs)
+        for _ in range(self.workers):
+            while True:
+                try:
+                    nonce, tried = results.next(timeout=POLL_INTERVAL)
+                    break
+                except mp.TimeoutError:
+                    if cancel and cancel.is_set() and not self.stop.is_set():
+                        cancelled = True
+                        self.stop.set()
+            hashes += tried
+            if nonce is not None and found is None:
+                found = nonce
+                self.stop.set()
+        elapsed = time.time() - start_time
+
+        self.hashes = hashes
+        self.hash_rate = hashes / elapsed if elapsed > 0 else 0
+        if cancelled or found is None:
+            return False
+        block.nonce = found
+        return True
+
+    def close(self):
+        '''
+        Stop all the worker processes.
+        '''
+        self.stop.set()
+        self.pool.terminate()
+        self.pool.join()
@@ -1,17 +1,30 @@
+import os
 import sys
 import time
-import math
 import random
 import socket
+import zlib
+import lzma
 from random import uniform
 from ast import literal_eval
-from threading import Thread
+from threading import Thread, Event, Lock
 from datetime import datetime
 
-from struct import pack, unpack
 from utils import *
 from block import *
 from blockchain import Blockchain
+from miner import Miner
+from store import ChainStore
+from state import snapshot_hash
+import protocol as msg
+from protocol import send_frame, FrameReader
+from pool import ConnectionPool, SEND_TIMEOUT
+from server import PeerServer
+from broadcast import Broadcaster
+from inventory import Inventory, INV_BLOCK, INV_TX, MAX_INV_ITEMS, encode_inv, decode_inv, ts_hash
+from sync import HeaderSync, encode_locator, decode_locator, MAX_HEADERS
+from compression import Compressor, Decompressor, CompressionStats, negotiate, CODECS, COMPRESS_THRESHOLD
+from codec import CodecError, encode_block, decode_block, encode_transaction, decode_transaction, encode_headers, decode_headers
 
 ################################
 # Peers are listening on 54321 #
@@ -21,6 +34,13 @@ from blockchain import Blockchain
 tracker_addr = ("172.16.213.130", 65431)
 peer_port = 54321
 
+# Chains are streamed one block per frame. The receiver acknowledges every
+# STREAM_WINDOW blocks once they are added, and the sender never gets more
+# than that ahead, so at most one window is buffered on either side.
+STREAM_WINDOW = 64
+STREAM_TIMEOUT = 30     # Seconds without progress before a chain transfer is dropped.
+
+
 class Peer:
     def __init__(self, stay_time):
         #self.my_ip = socket.gethostbyname(socket.gethostname())
@@ -29,9 +49,24 @@ class Peer:
         self.stay_time = stay_time
         self.peer_port = peer_port
         self.peer_list = []
-        self.peer_block_chain = {}  # key: bc sent by each peer. value: # of times they appear. used when initializing and handling conflicts.
         self.tracker_addr = tracker_addr
 
+        # Long-lived outbound connections to the other peers, used for every message we send.
+        self.pool = ConnectionPool(peer_port)
+        # Sends gossip to all the peers at once, each with its own deadline (see broadcast.py).
+        self.broadcaster = Broadcaster(self.pool)
+        # Blocks and transactions are announced by hash and fetched by the peers that miss them.
+        self.inventory = Inventory()
+        # Headers-first sync in progress, when joining or after being away (see sync.py).
+        self.sync = None
+        # Snapshot content hashes reported by the peers. Nothing on chain commits to a
+        # snapshot, so one is only used once a majority of the peers report its hash.
+        self.snapshot_votes = {}    # key: content hash. value: set of peers.
+        self.snapshot_data = {}     # key: content hash. value: snapshot received with that hash.
+        # Inbound messages are handled on a pool of threads (see server.py). They
+        # still change the local chain and state one at a time.
+        self.handler_lock = Lock()
+
         self.local_bc_built = False # Set to True when the local bc is built.
         self.conflict_solve = True  # Set to False when received "REQ_CHANGE", set back to True after resolving the conflict.
 
@@ -39,10 +74,32 @@ class Peer:
         self.name = f"{self.my_ip}@4119.com"
         #self.signature = sha256(self.my_ip.encode('utf-8')).hexdigest()
 
-        # Initialize the block chain
-        self.block_chain = Blockchain(self.my_ip)
+        # Initialize the block chain. Resumes from the local store if there is one.
+        # Only the bodies of the last {body_window} blocks are kept in memory, older
+        # ones are loaded from the store through an LRU cache of {body_cache_bytes}.
+        self.body_window = 100
+        self.body_cache_bytes = 8 * 1024 * 1024
+        self.block_chain = Blockchain(self.my_ip, ChainStore(f"../data/{self.my_ip}"),
+                                      self.body_window, self.body_cache_bytes)
         self.transaction_pool = []
-        self.curr_difficulty = "medium"
+        self.max_block_txs = 8      # Max number of transactions in one block.
+        self.ts_proofs = {}         # key: hash of a transaction. value: verified header of the block containing it.
+
+        # Parallel mining. The worker pool is created by start(), before any thread.
+        self.mine_workers = os.cpu_count()
+        self.miner = None
+
+        # Set whenever the tip of the local chain changes, so the block being mined
+        # is abandoned and rebuilt on top of the new tip.
+        self.mine_cancel = Event()
+        # Compression of chain transfers. The receiver picks the codec among the ones
+        # the sender offers. Single blocks and transactions are never compressed.
+        self.compression = list(CODECS)     # Accepted codecs, most preferred first. Empty: never compress.
+        self.compression_level = 6
+        self.compression_stats = CompressionStats()
+
+        self.wasted_hashes = 0      # Hashes spent on blocks that were orphaned before they were found.
+        self.orphaned_blocks = 0    # Number of block templates abandoned because of a new tip.
 
     def start(self):
         '''
@@ -52,6 +109,7 @@ class Peer:
         with open(f"../log/{self.my_ip} peer_list_log.txt", 'w') as f:
             f.write(f"Peer : {self.my_ip}, Stay time : {self.stay_time}\n")
 
+        self.miner = Miner(self.mine_workers)
         self.join()
         Thread(target=self.listen, daemon=True).start()
         Thread(target=self.heartbeat, daemon=True).start()
@@ -64,9 +122,8 @@ class Peer:
     def join(self):
         '''
         When a peer wants to join the network, it first notifies the tracker
-        After receiving the active peer list, it requires all the members on
-        this list to send it their copy of the block chain, and make its own
-        local block chain based on the majority rule.
+        After receiving the active peer list, it syncs its local block chain
+        headers-first from the members on this list (see start_sync).
         '''
 
         time.sleep(0.8) # Ensure the listen thread is running!!!!
@@ -82,233 +139,374 @@ class Peer:
     def listen(self):
         '''
         The peer listens from both the tracker and other peers on a certain port.
-        Different message types have corresponding prefixes and are handled differently.
+        All the connections are served at once by an asyncio event loop (see
+        server.py), and the messages of every connection are handled in order
+        on a pool of threads, so a slow sender (e.g. a long chain) doesn't hold
+        up the others. Every message is a frame with a one-byte message type
+        (see protocol.py). Handlers get a memoryview on the payload.
         Below is the message type it can received.
 
-        "PEER_LIST:"  : Peer list from the tracker.
-        "NEW_BLOCK:"  : New block from other peers.
-        "TRANSACTION:": New transaction made by one peer.
-        "REQUEST_BC"  : Request for the block chain. Sent by newly joined peers.
-        "RECEIVE_BC:" : Newly joined peer receives bc from others.
-        "REQ_CHANGE:" : One peer receives an invalid block, informing the sender.
+        PEER_LIST    : Peer list from the tracker.
+        NEW_BLOCK    : New block from other peers.
+        TRANSACTION  : New transaction made by one peer.
+        BC_BEGIN     : Start of a streamed chain, followed by BC_BLOCK frames and BC_END.
+                       Kind REQ_CHANGE : one peer receives an invalid block, informing the sender.
+        REQ_PROOF    : Request for the merkle proof of a transaction. Sent by other peers.
+        RECV_PROOF   : Merkle proof of a transaction with the header of its block.
+        REQ_SNAPSHOT : Request for the latest state snapshot, or only its hash. Sent by newly joined peers.
+        SNAPSHOT     : State snapshot (or only its hash), tied to a block of the sender's chain.
+        INV          : Hashes of new blocks and transactions. We ask for the ones we miss.
+        GET_DATA     : Request for the blocks and transactions we announced.
+        GET_HEADERS  : Request for our headers after the fork point of a block locator.
+        HEADERS      : Headers we asked for while syncing.
 
         TODO: Perhaps use different ports.
         '''
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(("0.0.0.0", self.peer_port))
-            s.listen(50)
-            print("Stay thread started. Listening .....")
-
-            while True:
-                client_socket, addr = s.accept()
-                # print(f"Connected to {addr[0]}")
-                try:
-                    while True:
-                        # First get the size of the message so that we know when to stop.
-                        size = client_socket.recv(4)
-                        if not size:
-                            break
-                        size = unpack(">I", size)[0]
-
-                        # Receive the message from the client.
-                        data = b""
-                        while len(data) < size:
-                            data += client_socket.recv(size - len(data))
-                        data = data.decode()
-
-                        if data:
-                            # Received updated peer list from tracker.
-                            if data.startswith("PEER_LIST:"): 
-                                self.handle_received_pl(data[10:])
-
-                            # Received new block from other peers.
-                            elif data.startswith("NEW_BLOCK:"):   
-                                self.handle_received_blk(data[10:], addr[0])
+        PeerServer(self.handle_message, self.peer_port).run()
 
-                            # Received new transaction from others.
-                            elif data.startswith("TRANSACTION:"):
-                                self.handle_received_ts(data[12:], addr[0])
-
-                            # Received new peer asking for local blockchain.
-                            elif data.startswith("REQUEST_BC"):
-                                self.send_block_chain(addr[0])
+    def handle_message(self, msg_type:int, payload, reader, addr):
+        '''
+        Dispatch one received message to its handler. {reader} gives the next
+        messages of the same connection and takes the replies.
+        '''
+        # Received a streamed blockchain. The rest of it comes on this connection.
+        # It takes the lock for every window of blocks, not while waiting for them.
+        if msg_type == msg.BC_BEGIN:
+            self.receive_block_chain(reader, str(payload, 'utf-8'), addr[0])
+            return
 
-                            # Received blockchain from others. Used when initializing local bc.
-                            elif data.startswith("RECEIVE_BC:"):
-                                if not self.local_bc_built:
-                                    self.handle_received_bc(data[11:], addr[0])
+        # Received request for announced items or headers, or hashes of new items.
+        # Only looking them up takes the lock, the replies are sent after.
+        if msg_type == msg.INV:
+            self.handle_inv(payload, addr[0])
+            return
+        if msg_type == msg.GET_DATA:
+            self.handle_get_data(payload, addr[0])
+            return
+        if msg_type == msg.GET_HEADERS:
+            self.handle_get_headers(payload, addr[0])
+            return
 
-                            # Received request to modify the local blockchain.
-                            elif data.startswith("REQ_CHANGE:"):
-                                self.conflict_solve = False
-                                self.handle_req_change(data[11:], addr[0])
+        with self.handler_lock:
+            self.dispatch(msg_type, payload, addr)
 
-                            # TODO: Other message types received.
-                        else:
-                            break
-                except Exception as e:
-                    print("Error during communication:", e)
+    def dispatch(self, msg_type:int, payload, addr):
+        # Received updated peer list from tracker.
+        if msg_type == msg.PEER_LIST:
+            self.handle_received_pl(str(payload, 'utf-8'))
 
-    def handle_req_change(self, data:str, addr):
-        '''
-        Handle the request to modify the local blockchain.
-        '''
+        # Received new block from other peers.
+        elif msg_type == msg.NEW_BLOCK:
+            self.handle_received_blk(payload, addr[0])
 
-        # Check if we know this peer. This has to be done here.
-        if addr not in self.peer_list:
-            print(f"<!!! WARNING !!!> : Suspicious change request from unknown sender {addr} !")
-            # TODO: Send "Who is this???" to the sender. If necessary, inform the tracker to block this ip.
-            self.conflict_solve = True
-            return
-        
-        received_bc = self.get_chain_from_data(data)
-        print(f"Received request change from {addr}")
+        # Received new transaction from others.
+        elif msg_type == msg.TRANSACTION:
+            self.handle_received_ts(payload, addr[0])
 
-        if not self.is_valid_bc(received_bc):
-            self.conflict_solve = True
-            return
+        # Received request for the merkle proof of a transaction.
+        elif msg_type == msg.REQ_PROOF:
+            self.handle_req_proof(str(payload, 'utf-8'), addr[0])
 
-        # Always have a genesis block.
-        if len(received_bc) > len(self.block_chain.chain) - 1:
-            self.block_chain.chain = [self.block_chain.chain[0]]
-            for blk in received_bc:
-                self.block_chain.chain.append(blk)
-            print(f"Updated local blockchain from {addr} as it's longer.")
-
-        # Use a heuristic method here. If two chains are of the same length, choose the one with the smaller hash.
-        elif len(received_bc) == len(self.block_chain.chain) - 1:
-            if received_bc[-1].hash < self.block_chain.chain[-1].hash:
-                self.block_chain.chain = [self.block_chain.chain[0]]
-                for blk in received_bc:
-                    self.block_chain.chain.append(blk)
-                print(f"Updated local blockchain from {addr} as it's the same length but has smaller hash.")
-            else:
-                print(f"Received an blockchain from {addr}. Same length, but larger hash. Ignored.")
+        # Received the merkle proof of a transaction we asked for.
+        elif msg_type == msg.RECV_PROOF:
+            self.handle_received_proof(str(payload, 'utf-8'), addr[0])
 
-        else:
-            print(f"Received an blockchain from {addr} but it's shorter than the local one. Ignored.")
+        # Received new peer asking for a state snapshot.
+        elif msg_type == msg.REQ_SNAPSHOT:
+            self.send_snapshot(addr[0], bytes(payload) == b"hash")
 
-        # Whatever the final decision is, we are done with the conflict solving.
-        self.conflict_solve = True
-    
-    def is_valid_bc(self, received_bc):
-        '''
-        Checks if the received blockchain is valid.
-        '''
-        if not received_bc:
-            print("Received an empty blockchain.")
-            return False
+        # Received a state snapshot. Used when initializing local bc.
+        elif msg_type == msg.SNAPSHOT:
+            if not self.local_bc_built:
+                self.handle_received_snapshot(str(payload, 'utf-8'), addr[0])
 
-        for i in range(1, len(received_bc)):
-            curr = received_bc[i]
-            prev = received_bc[i - 1]
-            if curr.hash != curr.calc_hash() or curr.previous_hash != prev.hash:
-                print("Received a blockchain but it might be tampered.")
-                print(curr.hash != curr.calc_hash(), curr.previous_hash != prev.hash)
-                return False
+        # Received headers while syncing.
+        elif msg_type == msg.HEADERS:
+            self.handle_received_headers(payload, addr[0])
 
-        return True
+        # TODO: Other message types received.
 
-    def handle_received_ts(self, data:str, addr):
+    def handle_received_ts(self, data, addr):
         '''
         Handle the received transaction. Add it to the transaction pool if it's valid.
+        Registrations and transfers are checked against the song ownership state.
+        A new valid transaction is announced to the other peers.
         '''
         # Check if we know this peer. This has to be done here.
         if addr not in self.peer_list:
             print(f"<!!! WARNING !!!> : Suspicious transaction from unknown sender {addr} !")
             # TODO: Send "Who is this???" to the sender. If necessary, inform the tracker to block this ip.
             return
-        ts = literal_eval(data)
-        type = ts['transaction_type']
-        if type == 'Register':
-            ts = Register('Register', ts['user_name'], ts['song_name'], ts['timestamp'], ts['signature'])
-        elif type == 'Transfer':
-            ts = Transfer('Transfer', ts['user_name'], ts['song_name'], ts['timestamp'], ts['signature'])
-        else:
-            print(f"Unknown transaction type received from {addr}.")
+        try:
+            ts = decode_transaction(data)
+        except CodecError as e:
+            print(f"Received a malformed transaction from {addr} : {e}")
+            return
+        ts, error = self.pool_transaction(ts)
+        if error:
+            print(f"Received an invalid transaction from {addr} : {error}")
+            return
+        item_hash = ts_hash(ts)
+        if not self.inventory.add_ts(item_hash):
             return
         self.transaction_pool.append(ts)
         print(f"Received new transaction from {addr}. Transaction pool size : {len(self.transaction_pool)}")
+        self.announce(INV_TX, item_hash, exclude=addr, wait=False)
 
-    def handle_received_bc(self, data:str, addr):
-        '''
-        data format : '{"index": "0", "timestamp":  ...  }END'
-        Collect the received data in peer_block_chain. If one
-        key corresponds to a value that is greater than half 
-        of the peer #, go with this and change local_bc_built
-        to True, and send it to self.build_chain_from_data().
+    def pool_transaction(self, ts:dict):
         '''
+        Builds the Transaction of a decoded one, checked against the song ownership state.
 
-        print(f"Received a blockchain sent by {addr}")
-
-        peer_number = len(self.peer_list)
-        self.peer_block_chain[data] = self.peer_block_chain.get(data, 0) + 1
-        if self.peer_block_chain[data] >= math.ceil(peer_number / 2):
-            self.local_bc_built = True
-            self.peer_block_chain = {} # Clear peer_block_chain.
-
-        block_serial = self.get_chain_from_data(data)
-        for blk in block_serial:
-            self.block_chain.chain.append(blk)
-
-        print(f"Local blockchain built. Length : {len(self.block_chain.chain)}")
+        Returns : (Transaction, None), or (None, why it can't go in the transaction pool).
+        '''
+        type = ts['transaction_type']
+        if type == 'Register':
+            if self.block_chain.state.owner_of(ts['song_name']) is not None:
+                return None, f"{ts['song_name']} is already registered."
+            transaction = Register(ts['user_name'], ts['song_name'], ts['timestamp'], ts['signature'])
+        elif type == 'Transfer':
+            error = self.block_chain.state.check_transfer(ts['user_name'], ts['song_name'], ts.get('other_user'))
+            if error:
+                return None, error
+            transaction = Transfer(ts['user_name'], ts['song_name'], ts['timestamp'], ts['signature'], ts['other_user'])
+        else:
+            return None, f"unknown transaction type {type}."
+        # The song file may only exist on the sender's side.
+        transaction.song_hash = ts['song_hash']
+        return transaction, None
 
-    def get_chain_from_data(self, data:str):
+    def receive_block_chain(self, reader, header:str, addr):
         '''
-        Build a chain from the received data.
-        Data format : '[Block 1][END][Block 2][END] ... [Block N][END]'
+        header format : '<kind>:<number of blocks>:<codecs offered by the sender>'
+        Receive a chain streamed by send_block_chain() through {reader}. Blocks are
+        validated and added to the block tree in windows of STREAM_WINDOW as
+        they arrive, the branch with the most work wins. Every window is
+        acknowledged once it is added, which lets the sender go on. The stream
+        is accepted with the codec we prefer among the offered ones, and
+        compressed frames are decompressed as they arrive.
+
+        The only kind is REQ_CHANGE : the whole chain of a peer that rejected
+        our block. Joining peers sync headers-first instead (see start_sync).
         '''
+        kind, count, offered = header.split(':')
+        sock = reader.sock
+        if kind != 'REQ_CHANGE':
+            print(f"Received a blockchain of unknown kind {kind} from {addr}.")
+            send_frame(sock, msg.BC_STOP)
+            return
+        if addr not in self.peer_list:
+            print(f"<!!! WARNING !!!> : Suspicious change request from unknown sender {addr} !")
+            # TODO: Send "Who is this???" to the sender. If necessary, inform the tracker to block this ip.
+            send_frame(sock, msg.BC_STOP)
+            return
+        self.conflict_solve = False
+        codec = negotiate(offered.split(','), self.compression)
+        decompressor = Decompressor(codec) if codec else None
+        send_frame(sock, msg.BC_ACCEPT, codec or '')
+        print(f"Receiving a blockchain of {count} blocks from {addr}, compression : {codec}")
+
+        old_tip = self.block_chain.tip().hash
+        window = []
+        received, valid = 0, True
+        try:
+            while True:
+                frame = reader.read()
+                if frame is None:
+                    break
+                msg_type, data = frame
+                if msg_type == msg.BC_ZBLOCK and decompressor:
+                    wire = len(data)
+                    data = decompressor.decompress(data)
+                    self.compression_stats.received(len(data), wire)
+                elif msg_type == msg.BC_BLOCK:
+                    self.compression_stats.received(len(data), len(data))
+                else:
+                    break
+                blk, _, _ = decode_block(data)
+                window.append(blk)
+                received += 1
+                if len(window) == STREAM_WINDOW:
+                    valid = self.add_blocks(window)
+                    window = []
+                    if not valid:
+                        send_frame(sock, msg.BC_STOP)
+                        break
+                    send_frame(sock, msg.BC_ACK, b"%d" % received)
+            if window and valid:
+                valid = self.add_blocks(window)
+        except (CodecError, OSError, zlib.error, lzma.LZMAError) as e:
+            print(f"Chain transfer from {addr} failed : {e}")
+            # Tell the sender to stop, if the connection still works.
+            try:
+                send_frame(sock, msg.BC_STOP)
+            except OSError:
+                pass
+        finally:
+            # Whatever the final decision is, we are done with the conflict solving.
+            self.conflict_solve = True
+        with self.handler_lock:
+            self.block_chain.check_pending_snapshot()
+            self.update_pool()
+            if self.block_chain.tip().hash != old_tip:
+                self.mine_cancel.set()
+                print(f"Updated local blockchain from {addr} as it has more work.")
+            else:
+                print(f"Received a blockchain from {addr}, but it doesn't have more work. Kept as a side branch.")
 
-        block_serial = []
-        block_list = data.split("END")[:-1]
-        for b in block_list:
-            b = literal_eval(b)
-            blk = Block(b['index'], b['timestamp'], b['data'], b['previous_hash'], b['signature'], b['difficulty'], b['nonce'], b['mine_time'])
-            block_serial.append(blk)
-
-        return block_serial
+    def add_blocks(self, blocks):
+        '''
+        Add received blocks to the block tree. Blocks we already know are skipped.
 
-    def send_block_chain(self, addr):
+        Returns : False if one of the new blocks is invalid.
         '''
-        Send the local block chain to the newly joined peer. This does not
-        include the genesis block. Place an "END" string at the end of each
-        block so that the receiver can parse the blocks and build the chain.
+        with self.handler_lock:
+            new = [blk for blk in blocks if not self.block_chain.knows_block(blk.hash)]
+            return self.block_chain.add_branch(new) == len(new)
 
-        XXX: We are sending the entire blockchain in one go.
+    def send_block_chain(self, addr, height=0):
+        '''
+        Stream the local blocks after {height} to a peer, one block per frame.
+        This never includes the genesis block. After every STREAM_WINDOW blocks,
+        wait until the receiver acknowledges them. Blocks are read and encoded
+        one at a time, the chain is never put together in memory. Blocks of at
+        least COMPRESS_THRESHOLD bytes are compressed with the codec the
+        receiver picked. The stream goes over the pooled 'bulk' connection to
+        the peer, which is dropped if the transfer doesn't finish cleanly.
         '''
 
         # There is always a genesis block.
-        if len(self.block_chain.chain) == 1:
-            print(f"{self.my_ip} has no block chain to send.")
+        end = len(self.block_chain.chain)
+        if end <= height + 1:
+            print(f"{self.my_ip} has no block after height {height} to send.")
             return
 
-        data = ""
-        for blk in self.block_chain.chain[1:]:
-            data += blk.serialize_block() + "END"
+        sent = 0
+        try:
+            with self.pool.connection(addr, 'bulk') as s:
+                if s is None:
+                    print(f"{self.my_ip} can't reach {addr} to send the blockchain.")
+                    return
+                s.settimeout(STREAM_TIMEOUT)
+                send_frame(s, msg.BC_BEGIN, f"REQ_CHANGE:{end - height - 1}:{','.join(self.compression)}")
+                reader = FrameReader(s, 64)
+                reply = reader.read()
+                if reply is None:
+                    raise ConnectionError("Connection closed.")
+                if reply[0] != msg.BC_ACCEPT:
+                    print(f"{addr} refused the blockchain.")
+                    return
+                codec = str(reply[1], 'utf-8')
+                compressor = Compressor(codec, self.compression_level) if codec in self.compression else None
+                for h in range(height + 1, end):
+                    # Runs in its own thread: the chain may change between two reads.
+                    with self.handler_lock:
+                        block = self.block_chain.get_block(h)
+                    # The chain got shorter (a reorg) while sending.
+                    if block is None:
+                        break
+                    data = encode_block(block)
+                    if compressor and len(data) >= COMPRESS_THRESHOLD:
+                        wire = compressor.compress(data)
+                        send_frame(s, msg.BC_ZBLOCK, wire)
+                    else:
+                        wire = data
+                        send_frame(s, msg.BC_BLOCK, data)
+                    self.compression_stats.sent(len(data), len(wire))
+                    sent += 1
+                    if sent % STREAM_WINDOW == 0:
+                        ack = reader.read()
+                        if ack is None or ack[0] != msg.BC_ACK:
+                            print(f"{addr} stopped the chain transfer after {sent} blocks.")
+                            self.pool.discard(addr, 'bulk')
+                            return
+                send_frame(s, msg.BC_END)
+            print(f"Sent local blockchain to {addr}. Length : {sent}")
+        except OSError as e:
+            print(f"{self.my_ip} failed to send the blockchain to {addr} : {e}")
+
+    def broadcast_block(self, blk_hash:str):
+        '''
+        After mining a new block (and proves it's valid), the peer announces
+        its hash to all other peers, concurrently. They fetch the block if
+        they don't have it yet.
+
+        Returns : {peer: (delivered, seconds to deliver)}
+        '''
+
+        results = self.announce(INV_BLOCK, blk_hash)
+        for peer, (sent, latency) in results.items():
+            if sent:
+                print(f"Announced a block to {peer} in {latency * 1000:.1f} ms.")
+        return results
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            # Connect to port 54321!!!!
-            s.connect((addr, peer_port))
-            message = "RECEIVE_BC:" + data
-            s.sendall(pack('>I', len(message)) + message.encode('utf-8'))
-            print(f"Sent local blockchain to {addr}. Length : {len(self.block_chain.chain) - 1}")
+    def announce(self, kind:int, item_hash:str, exclude=None, wait=True):
+        '''
+        Send an INV with one block or transaction hash to every peer but {exclude}
+        (the one we got the item from). Relays don't {wait} for the sends, they
+        are made while handling a message, with the handler lock held.
 
-    def broadcast_block(self, block:str):
+        Returns : {peer: (delivered, seconds to deliver)}, or None if not waiting.
         '''
-        After mining a new block (and proves it's valid), the peer broadcasts
-        this serialised block to all other peers.
+        peers = [peer for peer in self.peer_list if peer != exclude]
+        payload = encode_inv([(kind, item_hash)])
+        if not wait:
+            self.broadcaster.post(peers, msg.INV, payload, self.announced)
+            return None
+        results = self.broadcaster.broadcast(peers, msg.INV, payload)
+        for peer, (sent, latency) in results.items():
+            self.announced(peer, sent, latency)
+        return results
+
+    def announced(self, peer:str, sent:bool, latency:float):
+        if not sent:
+            print(f"{self.my_ip} failed to announce an item to {peer} ({latency:.2f} s).")
+
+    def has_item(self, kind:int, item_hash:str):
+        if kind == INV_BLOCK:
+            return self.block_chain.knows_block(item_hash)
+        return self.inventory.has_ts(item_hash)
+
+    def handle_inv(self, data, addr):
         '''
+        Ask the announcer for the announced items we don't have and nobody is sending us already.
+        '''
+        if addr not in self.peer_list:
+            print(f"<!!! WARNING !!!> : Suspicious announcement from unknown sender {addr} !")
+            return
+        try:
+            items = decode_inv(data)
+        except CodecError as e:
+            print(f"Received a malformed announcement from {addr} : {e}")
+            return
+        with self.handler_lock:
+            wanted = self.inventory.want(items, self.has_item)
+        if wanted:
+            self.send_message(addr, msg.GET_DATA, encode_inv(wanted))
 
-        for peer in self.peer_list:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect((peer, peer_port))
-                    message = "NEW_BLOCK:" + block
-                    s.sendall(pack('>I', len(message)) + message.encode('utf-8'))
-                    print(f"\n\nSent a block \n\n {block}\n\n")
-                except Exception as e:
-                    print(f"{self.my_ip} failed to broadcast a block to {peer} : {e}")
+    def handle_get_data(self, data, addr):
+        '''
+        Send the requested blocks and transactions. Unknown items (e.g. a
+        block that left the main chain) are skipped.
+        '''
+        try:
+            items = decode_inv(data)
+        except CodecError as e:
+            print(f"Received a malformed data request from {addr} : {e}")
+            return
+        replies = []
+        with self.handler_lock:
+            pool = {ts_hash(ts): ts for ts in self.transaction_pool} if any(kind == INV_TX for kind, _ in items) else {}
+            for kind, item_hash in items:
+                if kind == INV_BLOCK:
+                    blk = self.block_chain.get_block_by_hash(item_hash)
+                    if blk is not None:
+                        replies.append((msg.NEW_BLOCK, encode_block(blk)))
+                elif item_hash in pool:
+                    replies.append((msg.TRANSACTION, encode_transaction(pool[item_hash])))
+        for msg_type, payload in replies:
+            if not self.send_message(addr, msg_type, payload):
+                break
 
     def handle_received_blk(self, block, addr):
         '''
@@ -322,30 +520,355 @@ class Peer:
             # TODO: Send "Who is this???" to the sender. If necessary, inform the tracker to block this ip.
             return
 
-        block = literal_eval(block)
-        blk = Block(index=block['index'], timestamp=block['timestamp'], transaction=block['data'],\
-        previous_hash=block['previous_hash'], signature=block['signature'], difficulty=block['difficulty'], nonce=block['nonce'], mine_time=block['mine_time'])
-        blk_hash = block['hash']
+        try:
+            blk, blk_hash, _ = decode_block(block)
+        except CodecError as e:
+            print(f"Received a malformed block from {addr} : {e}")
+            return
+
+        # A block we asked for while syncing. It's connected once the blocks before it are.
+        if self.sync:
+            # Sent twice, by a peer that answered after its request was given to another one.
+            if blk_hash in self.sync.bodies:
+                return
+            if self.sync.expects(blk_hash):
+                self.add_synced_block(blk, blk_hash, addr)
+                return
+
+        self.inventory.received(blk_hash)
+        # Already have it, e.g. the same block sent again. Nothing to do.
+        if self.block_chain.knows_block(blk_hash):
+            return
 
         #print(f"Hey it's a new block! Size is {len(block)}")
         print(f"\n\nReceived a block from {addr} \n\n {blk.serialize_block()}\n\n")
 
-        if self.block_chain.add_block(blk, blk_hash, addr):
+        # Blocks are relayed, so the sender isn't always the miner. The signature
+        # is checked against the miner if it's one of our peers, else the sender.
+        miners = {sha256(peer.encode('utf-8')).hexdigest(): peer for peer in self.peer_list}
+        old_tip = self.block_chain.tip().hash
+        if self.block_chain.add_block(blk, blk_hash, miners.get(blk.signature, addr)):
             print(f"{self.my_ip} added a block to local coming from {addr}")
-            mine_time = block["mine_time"]
-            self.curr_difficulty = switch_difficulty(mine_time, self.curr_difficulty)
+            self.update_pool()
+            if self.block_chain.tip().hash != old_tip:
+                # Whatever we are mining now is stale.
+                self.mine_cancel.set()
+                # Relay it. The peers that already have it won't fetch it again.
+                self.announce(INV_BLOCK, blk_hash, exclude=addr, wait=False)
+
+        elif not self.block_chain.knows_block(self.block_chain.parent_hash(blk)):
+            # We miss the blocks before it, e.g. we were away. Fetch them unless we are already syncing.
+            if self.sync is None:
+                print(f"Received block {blk.index} from {addr}, but not the blocks before it. Syncing.")
+                self.start_sync(addr)
 
         else:
             # print some information about the blocks
             print(f"\n\nLast block index : {self.block_chain.chain[-1].index}, received block index : {blk.index}\n\n")
-            data = ""
-            for blk in self.block_chain.chain[1:]:
-                data += blk.serialize_block() + "END"
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((addr, peer_port))
-                message = "REQ_CHANGE:" + data
-                s.sendall(pack('>I', len(message)) + message.encode('utf-8'))
-                print(f"Sent block chain to {addr}, requesting change.")
+            print(f"Sending block chain to {addr}, requesting change.")
+            Thread(target=self.send_block_chain, args=(addr,), daemon=True).start()
+
+    def start_sync(self, peer):
+        '''
+        Start a headers-first sync with {peer}: send it our block locator, it
+        answers with the headers after our fork point. A fresh peer first asks
+        for a state snapshot, instead of replaying every block.
+        '''
+        self.sync = HeaderSync(peer)
+        if len(self.block_chain.chain) == 1:
+            self.request_snapshot(peer)
+        self.request_headers(peer)
+
+    def request_headers(self, peer, resume=False):
+        '''
+        Ask {peer} for the headers after our fork point, or after the last
+        header of the branch we are downloading if {resume}.
+        '''
+        self.sync.wait_headers(peer, resume)
+        locator = self.block_chain.locator()
+        height = len(self.block_chain.chain) - 1
+        if resume:
+            last, last_hash = self.sync.branch[-1]
+            locator, height = [last_hash] + locator, last.index
+        self.post_message(peer, msg.GET_HEADERS, encode_locator(locator))
+        print(f"Asked {peer} for the headers after height {height}.")
+
+    def handle_get_headers(self, data, addr):
+        '''
+        Send the headers of our main chain after the fork point of the received block locator.
+        '''
+        try:
+            locator = decode_locator(data)
+        except CodecError as e:
+            print(f"Received a malformed block locator from {addr} : {e}")
+            return
+        with self.handler_lock:
+            headers = encode_headers(self.block_chain.headers_after(locator, MAX_HEADERS))
+        self.send_message(addr, msg.HEADERS, headers)
+
+    def handle_received_headers(self, data, addr):
+        '''
+        Validate a batch of headers from the peer we sync with, then ask all the
+        peers for the bodies. A full batch with no more work than our chain may
+        be part of a deeper fork, the headers after it are asked for. An empty
+        batch, or a branch with no more work than our chain, means the peer has
+        nothing better for us.
+        '''
+        if self.sync is None or addr != self.sync.peer:
+            return
+        try:
+            headers = decode_headers(data)
+        except CodecError as e:
+            print(f"Received malformed headers from {addr} : {e}")
+            return
+        full = len(headers) == MAX_HEADERS
+        branch = self.sync.branch
+        if branch and headers and headers[0][0].previous_hash != branch[-1][1]:
+            # The peer switched branches since its last batch. Start over from its fork point.
+            print(f"{addr} sent headers that don't continue its last batch.")
+            self.request_headers(addr)
+            return
+        # The first headers can be on our main chain too, when our fork point
+        # is between two hashes of the locator. They don't need to be fetched.
+        while not branch and headers and self.block_chain.has_block(headers[0][1]):
+            headers.pop(0)
+        if not headers:
+            self.peer_synced(addr)
+            return
+        work = self.block_chain.check_headers(headers, branch)
+        if work is None:
+            print(f"Received invalid headers from {addr}.")
+            self.next_sync_peer()
+            return
+        if work <= self.block_chain.work[self.block_chain.tip().hash]:
+            if full:
+                self.sync.branch = branch + headers
+                self.request_headers(addr, resume=True)
+            else:
+                self.peer_synced(addr)
+            return
+        print(f"Received {len(headers)} headers from {addr}, up to height {headers[-1][0].index}.")
+        self.sync.set_headers(branch + headers, not full)
+        self.request_bodies(self.sync.request_batch(self.peer_list))
+
+    def request_bodies(self, ranges):
+        for peer, hashes in ranges.items():
+            for start in range(0, len(hashes), MAX_INV_ITEMS):
+                self.post_message(peer, msg.GET_DATA, encode_inv([(INV_BLOCK, h) for h in hashes[start:start + MAX_INV_ITEMS]]))
+
+    def add_synced_block(self, blk, blk_hash, addr):
+        '''
+        Keep a block of the batch we are syncing, and connect the ones that can be.
+        '''
+        if blk.calc_digest().hex() != blk_hash or not blk.check_mrkl_root():
+            print(f"Received a tampered block from {addr} while syncing.")
+            return
+        self.sync.add_body(blk, blk_hash)
+        old_tip = self.block_chain.tip().hash
+        for block in self.sync.ready():
+            if not self.block_chain.knows_block(block.hash) and not self.block_chain.add_block(block, block.hash):
+                print(f"Block {block.index} doesn't connect to the local chain. Starting over.")
+                self.update_pool()
+                self.next_sync_peer()
+                return
+        self.update_pool()
+        if self.block_chain.tip().hash != old_tip:
+            self.mine_cancel.set()
+        if self.sync.batch_done():
+            if self.sync.last_batch:
+                self.peer_synced(self.sync.peer)
+            else:
+                self.request_headers(self.sync.peer)
+
+    def next_sync_peer(self):
+        '''
+        Sync again with another peer, e.g. after invalid headers or blocks.
+        '''
+        others = [peer for peer in self.peer_list if peer != self.sync.peer]
+        self.request_headers(random.choice(others or self.peer_list))
+
+    def peer_synced(self, peer):
+        '''
+        {peer} has nothing with more work than our chain. The sync is over once
+        every peer says so, until then the next one is asked.
+        '''
+        self.sync.synced.add(peer)
+        others = [other for other in self.peer_list if other not in self.sync.synced]
+        if others:
+            self.request_headers(random.choice(others))
+        else:
+            self.finish_sync()
+
+    def finish_sync(self):
+        self.sync = None
+        self.block_chain.check_pending_snapshot()
+        self.local_bc_built = True
+        print(f"Local blockchain synced. Length : {len(self.block_chain.chain)}")
+
+    def check_sync(self):
+        '''
+        Send the sync requests that got no answer in time to other peers.
+        '''
+        with self.handler_lock:
+            if self.sync is None or not self.peer_list:
+                return
+            if self.sync.headers_expire is not None:
+                if self.sync.headers_expire < time.time():
+                    print(f"{self.sync.peer} didn't send the headers in time.")
+                    self.next_sync_peer()
+                return
+            self.request_bodies(self.sync.expired(self.peer_list))
+
+    def update_pool(self):
+        '''
+        Reconcile the transaction pool with the main chain, after blocks were added.
+        The transactions of the blocks a reorg rolled back go back to the pool if
+        they are still valid, the ones of the newly connected blocks leave it. Mined
+        transactions count as seen, so they aren't fetched again when announced.
+        '''
+        disconnected, connected = self.block_chain.take_changes()
+        mined = {ts for block in connected for ts in block.transactions}
+        for ts in mined:
+            self.inventory.add_ts(ts_hash(ts))
+        pool = [ts for ts in self.transaction_pool if ts.serialize_transaction() not in mined]
+
+        pooled = {ts_hash(ts) for ts in pool}
+        returned = []
+        for block in reversed(disconnected):
+            for data in block.transactions:
+                if data in mined or ts_hash(data) in pooled:
+                    continue
+                try:
+                    ts, error = self.pool_transaction(json.loads(data))
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if ts is not None:
+                    pooled.add(ts_hash(ts))
+                    returned.append(ts)
+        if returned:
+            print(f"{len(returned)} transactions of rolled back blocks are back in the transaction pool.")
+        # They are older than the ones still waiting.
+        self.transaction_pool = returned + pool
+
+    def request_ts_proof(self, ts_hash:str):
+        '''
+        Ask every peer for the merkle proof of a transaction. Verified answers
+        are kept in self.ts_proofs, no block body is needed.
+        '''
+        for peer in self.peer_list:
+            self.send_message(peer, msg.REQ_PROOF, ts_hash)
+
+    def handle_req_proof(self, ts_hash:str, addr):
+        '''
+        Send the merkle proof of a transaction, along with the header of its block.
+        '''
+        if addr not in self.peer_list:
+            print(f"<!!! WARNING !!!> : Suspicious proof request from unknown sender {addr} !")
+            return
+        result = self.block_chain.get_ts_proof(ts_hash)
+        if result is None:
+            print(f"{addr} asked for the proof of an unknown transaction.")
+            return
+        header, proof = result
+        self.post_message(addr, msg.RECV_PROOF, json.dumps({'ts_hash': ts_hash, 'header': header, 'proof': proof}))
+
+    def handle_received_proof(self, data:str, addr):
+        '''
+        Verify a merkle proof against the block header it came with, which
+        must be the header of a block of our main chain.
+        '''
+        try:
+            data = json.loads(data)
+            header = json.loads(data['header'])
+            valid = self.block_chain.check_ts_proof(data['ts_hash'], data['proof'], header)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Received a malformed merkle proof from {addr} : {e}")
+            return
+        if valid:
+            self.ts_proofs[data['ts_hash']] = header
+            print(f"Transaction {data['ts_hash'][:8]}... is in block {header['index']} (proof from {addr}).")
+        else:
+            print(f"Received an invalid merkle proof from {addr}.")
+
+    def request_snapshot(self, peer):
+        '''
+        Ask {peer} for its latest state snapshot, and the other peers for the
+        hash of theirs.
+        '''
+        self.snapshot_votes, self.snapshot_data = {}, {}
+        for other in self.peer_list:
+            self.post_message(other, msg.REQ_SNAPSHOT, b"" if other == peer else b"hash")
+
+    def send_snapshot(self, addr, hash_only=False):
+        '''
+        Send the latest state snapshot with its content hash, or only the hash.
+        '''
+        if self.block_chain.snapshot is None:
+            print(f"{self.my_ip} has no snapshot to send.")
+            return
+        height, data = self.block_chain.snapshot
+        reply = {'hash': snapshot_hash(data)}
+        if not hash_only:
+            reply['snapshot'] = data.decode()
+        self.post_message(addr, msg.SNAPSHOT, json.dumps(reply))
+        print(f"Sent the snapshot at height {height} to {addr}.")
+
+    def handle_received_snapshot(self, data:str, addr):
+        '''
+        Count the snapshot hash a peer reports. Once a majority of the peers
+        report the same hash, the snapshot with that hash is kept, so the
+        blocks up to it are not replayed into the state. It is only used if
+        the block it is tied to ends up in our chain.
+        '''
+        if addr not in self.peer_list:
+            print(f"<!!! WARNING !!!> : Suspicious snapshot from unknown sender {addr} !")
+            return
+        try:
+            data = json.loads(data)
+            content_hash = data['hash']
+            snapshot = data['snapshot'].encode() if 'snapshot' in data else None
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Received a malformed snapshot from {addr} : {e}")
+            return
+        if snapshot is not None:
+            if snapshot_hash(snapshot) != content_hash:
+                print(f"Received a snapshot from {addr} that doesn't match its hash.")
+                return
+            self.snapshot_data[content_hash] = snapshot
+
+        # Every peer votes once, for the last hash it reported.
+        for voters in self.snapshot_votes.values():
+            voters.discard(addr)
+        voters = self.snapshot_votes.setdefault(content_hash, set())
+        voters.add(addr)
+        if len(voters) <= len(self.peer_list) // 2:
+            return
+        if content_hash in self.snapshot_data:
+            if self.block_chain.use_snapshot(self.snapshot_data[content_hash], content_hash):
+                print(f"Received a state snapshot confirmed by {len(voters)} peers.")
+            self.snapshot_votes, self.snapshot_data = {}, {}
+        elif snapshot is None:
+            # The majority doesn't agree with the snapshot we got. Ask one of them for theirs.
+            self.post_message(addr, msg.REQ_SNAPSHOT)
+
+    def send_message(self, addr, msg_type:int, payload=b""):
+        '''
+        Send one message to a peer over the pooled connection. {payload} is str or bytes.
+
+        Returns : True if the message was sent.
+        '''
+        return self.pool.send(addr, msg_type, payload)
+
+    def post_message(self, addr, msg_type:int, payload=b""):
+        '''
+        Queue one message to a peer and return right away. Used with the handler
+        lock held: a slow or unreachable peer mustn't hold up the other handlers.
+        '''
+        self.broadcaster.post([addr], msg_type, payload, self.posted, SEND_TIMEOUT)
+
+    def posted(self, peer:str, sent:bool, latency:float):
+        if not sent:
+            print(f"{self.my_ip} failed to send a message to {peer} ({latency:.2f} s).")
 
     def handle_received_pl(self, data):
         '''
@@ -360,20 +883,13 @@ class Peer:
         received_list = literal_eval(data)
         print(f"{self.my_ip} received peer list with {len(received_list)} peers.")
 
-        # If peer list is empty, initialize peer list, build connection with them and ask for their bc.
+        # If peer list is empty, initialize peer list and sync the local bc with the peers.
         if not self.peer_list and len(received_list) > 1:
             for peer in received_list:
                 if peer != self.my_ip:
                     self.peer_list.append(peer)
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                        try:
-                            sock.connect((peer, peer_port))
-                            message = 'REQUEST_BC'
-                            sock.sendall(pack('>I', len(message)) + message.encode('utf-8'))
-                            print(f"Sent request bc message to {peer}")
-                        except Exception as e:
-                            print(f"Errors when connecting to peers : {e}")
-                            sys.exit()
+            # Headers come from one peer, the blocks we miss from all of them.
+            self.start_sync(random.choice(self.peer_list))
 
             if record:
                 self.log(peer_or_block='peer', to_file=True)
@@ -384,6 +900,7 @@ class Peer:
             for peer in self.peer_list:
                 if peer not in received_list:
                     self.peer_list.remove(peer)
+                    self.pool.forget(peer)
                     break
             print(f"{self.my_ip} removing {peer} from the its peer list.")
 
@@ -399,13 +916,8 @@ class Peer:
                 print(f"{self.my_ip} received a redundant peer : {new_peer}")
 
             self.peer_list.append(new_peer)
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                try:
-                    sock.connect((new_peer, peer_port))
-                    # print(f"Connected to {new_peer}")
-                except Exception as e:
-                    print(f"Failed when trying to connect with {new_peer} : {e}")
-                    sys.exit()
+            # Open the pooled connection now, so the next broadcast doesn't wait for it.
+            self.pool.get(new_peer)
             print(f"{new_peer} joined the network.")
 
             if record:
@@ -420,8 +932,11 @@ class Peer:
 
     def heartbeat(self):
     # Connect to the tracker and send a heartbeat message every 5 seconds.
+    # Also drop the pooled peer connections that died or went idle.
         time.sleep(5)
         while self.connected:
+            self.pool.check_health()
+            self.check_sync()
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                     s.connect(self.tracker_addr)
@@ -433,15 +948,8 @@ class Peer:
             time.sleep(5)
 
     def connect_to_peers(self):
-        for peer in self.peer_list:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                try:
-                    sock.connect((peer, peer_port))
-                    self.peer_sockets[peer] = sock
-                except Exception as e:
-                    print(f"Errors when connecting to peers : {e}")
-                    sys.exit()   
-        print(f"{self.my_ip} successfully connected to all peers.")
+        if all([self.pool.get(peer) for peer in self.peer_list]):
+            print(f"{self.my_ip} successfully connected to all peers.")
 
         if record:
             self.log()
@@ -459,6 +967,13 @@ class Peer:
         except Exception as e:
             print(f"Error leaving the tracker : {e}")
 
+        if self.miner:
+            self.miner.close()
+        if self.block_chain.validation_pool:
+            self.block_chain.validation_pool.terminate()
+        self.broadcaster.close()
+        self.pool.close()
+
         # Log the blockchain information before leaving.
         self.log(peer_or_block='block', to_file=True)
 
@@ -491,14 +1006,12 @@ class Peer:
             time.sleep(sleep_time)
 
     def broadcast_transaction(self, ts):
-        for peer in self.peer_list:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect((peer, peer_port))
-                    message = "TRANSACTION:" + ts.serialize_transaction()
-                    s.sendall(pack('>I', len(message)) + message.encode('utf-8'))
-                except Exception as e:
-                    print(f"{self.my_ip} failed to broadcast transaction to {peer} : {e}")
+        '''
+        Announce a transaction of the transaction pool to all other peers.
+        '''
+        item_hash = ts_hash(ts)
+        self.inventory.add_ts(item_hash)
+        return self.announce(INV_TX, item_hash)
 
     def start_mine(self):
         '''
@@ -506,37 +1019,64 @@ class Peer:
             - Every 20 seconds.
             - Transaction pool reaches a certain size (3). (I am using this one)
 
-        NOTE: Consider a block contains only one ts for now. Using a fixed difficulty (medium).
+        A block takes up to {self.max_block_txs} transactions from the pool. The target is derived from the chain.
+        When a new tip arrives while mining, the search is cancelled and a new
+        block is built on top of it right away.
         '''
+        rebuild = False
         while self.connected:
             # If we are in conflict solving mode, just wait until it's resolved.
             if not self.conflict_solve:
                 continue
             if len(self.transaction_pool) >= 3:
                 # sleep for a random time between 1 and 3 seconds before mining.
-                time.sleep(random.uniform(1, 3))
-                ts = self.transaction_pool[0].serialize_transaction()
-                create_time = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                block = Block(index=len(self.block_chain.chain), timestamp=create_time, transaction=ts,\
-                        previous_hash=self.block_chain.chain[-1].hash, difficulty=self.curr_difficulty, signature=self.signature)
+                if not rebuild:
+                    time.sleep(random.uniform(1, 3))
+                rebuild = False
+
+                # Clear before reading the tip, so a block arriving from now on cancels this template.
+                self.mine_cancel.clear()
+                transactions = [ts.serialize_transaction() for ts in self.transaction_pool[:self.max_block_txs]]
+                create_time = self.block_chain.next_timestamp()
+                block = Block(index=len(self.block_chain.chain), timestamp=create_time, transactions=transactions,\
+                        previous_hash=self.block_chain.chain[-1].hash, difficulty=self.block_chain.next_target(), signature=self.signature)
 
                 start_time = time.time()
-                block.mine()
+                mined = block.mine(self.miner, self.mine_cancel)
 
                 # If the peer is disconnected during mining, just discard the block.
                 if not self.connected:
                     break
+
+                if not mined:
+                    self.wasted_hashes += self.miner.hashes
+                    self.orphaned_blocks += 1
+                    print(f"{self.my_ip} abandoned block {block.index}, a new tip arrived. Wasted hashes : {self.wasted_hashes}")
+                    rebuild = True
+                    continue
+
                 end_time = time.time()
                 mine_time = round(end_time - start_time, 2)
 
-                print(f"{self.my_ip} mined a block in {mine_time} seconds.")
+                print(f"{self.my_ip} mined a block in {mine_time} seconds. Hash rate : {self.miner.hash_rate:.0f} H/s")
                 block.mine_time = mine_time
 
-                self.curr_difficulty = switch_difficulty(mine_time, self.curr_difficulty)
-                if self.block_chain.add_block(block, block.hash):
-                    self.broadcast_block(block.serialize_block())
-                    del self.transaction_pool[0]
+                with self.handler_lock:
+                    added = self.block_chain.add_block(block, block.hash)
+                    self.update_pool()
+                if added and self.block_chain.tip().hash == block.hash:
+                    self.broadcast_block(block.hash)
+                elif self.block_chain.tip().hash != block.previous_hash:
+                    # Lost the race to a block that arrived right before we finished.
+                    self.wasted_hashes += self.miner.hashes
+                    self.orphaned_blocks += 1
+                    rebuild = True
+                    continue
                 else:
+                    # The tip didn't move, so the template itself was rejected. Don't
+                    # remine it right away: the usual pause before mining applies.
+                    self.wasted_hashes += self.miner.hashes
+                    print(f"{self.my_ip} mined block {block.index}, but it was rejected by the local chain.")
                     continue
 
     def log(self, peer_or_block, to_file=False):
@@ -565,6 +1105,8 @@ class Peer:
             # Log the blockchain information.
             # Truncate to last 10 blocks in the terminal if the chain is too long.
             print(f"\n\n\n=========== {self.my_ip} Final Blockchain ===========")
+            print(f"Body cache : {self.block_chain.cache_stats()}")
+            print(f"Chain transfer compression : {self.compression_stats.stats()}")
             bc_copy = self.block_chain.chain
             if (len(bc_copy) > 10):
                 print("\n\n Blockchain too long, truncating to last 10 blocks.")
@@ -0,0 +1,213 @@
+import time
+import socket
+import select
+from threading import Lock
+from contextlib import contextmanager
+from protocol import send_frame
+
+# Seconds to wait for a connection or a blocked send before giving up.
+CONNECT_TIMEOUT = 5
+SEND_TIMEOUT = 30
+
+# After a failure, a peer is not tried again for BACKOFF_BASE * 2^(failures - 1)
+# seconds, at most MAX_BACKOFF.
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 30
+
+# Connections unused for this long are closed by the health check.
+IDLE_TIMEOUT = 120
+
+
+class Connection:
+    '''
+    A long-lived connection to a peer. The lock gives a sender exclusive use of it.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = Lock()
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    '''
+    Outbound connections to the peers, kept open and reused, keyed by
+    (address, channel). Gossip goes through the 'gossip' channel, and chain
+    transfers get a 'bulk' one so they don't hold up gossip to the same peer.
+
+    A connection that fails is dropped. The peer then gets an exponential
+    backoff before the next attempt, so an unreachable peer costs one failed
+    connect per backoff period instead of one per message. check_health()
+    drops connections the other side closed, and the ones idle for too long.
+    '''
+
+    def __init__(self, port:int):
+        self.port = port
+        self.lock = Lock()
+        self.conns = {}         # key: (address, channel). value: Connection
+        self.failures = {}      # key: address. value: (failures in a row, time of the next attempt)
+
+    def get(self, addr:str, channel:str='gossip', timeout:float=None):
+        '''
+        The pooled connection to {addr}, opened if needed. A new connection
+        gets at most {timeout} seconds (CONNECT_TIMEOUT by default).
+
+        Returns : The Connection, or None if {addr} is backing off or can't be reached.
+        '''
+        with self.lock:
+            conn = self.conns.get((addr, channel))
+            if conn is not None:
+                return conn
+            failures, retry_at = self.failures.get(addr, (0, 0))
+            if time.time() < retry_at:
+                return None
+
+        timeout = CONNECT_TIMEOUT if timeout is None else min(CONNECT_TIMEOUT, timeout)
+        if timeout <= 0:
+            return None
+        try:
+            sock = socket.create_connection((addr, self.port), timeout=timeout)
+        except OSError as e:
+            self.failed(addr)
+            print(f"Failed to connect to {addr} : {e}")
+            return None
+        sock.settimeout(SEND_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        with self.lock:
+            self.failures.pop(addr, None)
+            # Another thread may have connected in the meantime.
+            if (addr, channel) in self.conns:
+                sock.close()
+            else:
+                self.conns[(addr, channel)] = Connection(sock)
+            return self.conns[(addr, channel)]
+
+    def failed(self, addr:str):
+        with self.lock:
+            failures = self.failures.get(addr, (0, 0))[0] + 1
+            self.failures[addr] = (failures, time.time() + min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (failures - 1)))
+
+    def discard(self, addr:str, channel:str='gossip'):
+        '''
+        Close and forget a connection, e.g. after an error on it.
+        '''
+        with self.lock:
+            conn = self.conns.pop((addr, channel), None)
+        if conn is not None:
+            conn.close()
+
+    def forget(self, addr:str):
+        '''
+        Close every connection to a peer that left, and forget its failures.
+        '''
+        with self.lock:
+            keys = [key for key in self.conns if key[0] == addr]
+            self.failures.pop(addr, None)
+        for key in keys:
+            self.discard(*key)
+
+    @contextmanager
+    def connection(self, addr:str, channel:str='gossip'):
+        '''
+        Exclusive use of the connection to {addr}, e.g. for a request and its
+        replies. Yields None if there is no connection. On an error the
+        connection is dropped, the peer backs off, and the error is raised.
+        '''
+        conn = self.get(addr, channel)
+        if conn is None:
+            yield None
+            return
+        with conn.lock:
+            try:
+                yield conn.sock
+                conn.last_used = time.time()
+            except OSError:
+                self.discard(addr, channel)
+                self.failed(addr)
+                raise
+
+    def send(self, addr:str, msg_type:int, payload=b"", timeout:float=None):
+        '''
+        Send one frame to {addr}. A pooled connection may have been closed by
+        the other side since it was last used, so a failed send is retried
+        once on a new connection. With a {timeout}, the whole send (waiting
+        for the connection, connecting, writing) gives up after that many
+        seconds.
+
+        Returns : True if the frame was sent.
+        '''
+        expires = None if timeout is None else time.time() + timeout
+        for attempt in range(2):
+            conn = self.get(addr, timeout=remaining(expires))
+            if conn is None:
+                return False
+            if not conn.lock.acquire(timeout=-1 if expires is None else max(0, remaining(expires))):
+                print(f"Timed out waiting for the connection to {addr}.")
+                return False
+            try:
+                if expires is not None:
+                    conn.sock.settimeout(max(0.001, remaining(expires)))
+                send_frame(conn.sock, msg_type, payload)
+                conn.last_used = time.time()
+                return True
+            except OSError as e:
+                error = e
+            finally:
+                if expires is not None:
+                    try:
+                        conn.sock.settimeout(SEND_TIMEOUT)
+                    except OSError:
+                        pass
+                conn.lock.release()
+            # A frame cut short by the timeout leaves the connection unusable.
+            self.discard(addr)
+            if expires is not None and remaining(expires) <= 0:
+                break
+        self.failed(addr)
+        print(f"Failed to send a message to {addr} : {error}")
+        return False
+
+    def check_health(self):
+        '''
+        Drop the connections that were closed by the other side (readable with
+        nothing to read: nothing is ever sent back on an idle connection) and
+        the ones idle for more than IDLE_TIMEOUT.
+        '''
+        now = time.time()
+        with self.lock:
+            conns = list(self.conns.items())
+        for key, conn in conns:
+            if not conn.lock.acquire(blocking=False):
+                continue    # In use.
+            try:
+                dead = now - conn.last_used > IDLE_TIMEOUT
+                if not dead:
+                    readable, _, _ = select.select([conn.sock], [], [], 0)
+                    dead = bool(readable) and not conn.sock.recv(1, socket.MSG_PEEK)
+            except OSError:
+                dead = True
+            finally:
+                conn.lock.release()
+            if dead:
+                self.discard(*key)
+
+    def close(self):
+        with self.lock:
+            conns = list(self.conns.values())
+            self.conns = {}
+        for conn in conns:
+            conn.close()
+
+
+def remaining(expires):
+    '''
+    Seconds left until {expires} (a time.time() value), or None without a deadline.
+    '''
+    return None if expires is None else expires - time.time()
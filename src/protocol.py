@@ -0,0 +1,140 @@
+import asyncio
+from struct import Struct
+
+# Frame layout : [payload length (4)][message type (1)][payload]
+FRAME_HEADER = Struct('>IB')
+
+# Size of the receive buffer of a connection. It grows for larger frames.
+INITIAL_BUFFER = 64 * 1024
+
+# Frames larger than this are refused, the connection is dropped.
+MAX_FRAME = 256 * 1024 * 1024
+
+# Message types.
+PEER_LIST = 1       # Peer list from the tracker.
+NEW_BLOCK = 2       # New block from other peers.
+TRANSACTION = 3     # New transaction made by one peer.
+# 4 was REQUEST_BC, a request for the blocks after a height. Joining peers sync headers-first now.
+BC_BEGIN = 5        # Start of a streamed chain: '<kind>:<number of blocks>:<offered codecs>'.
+BC_BLOCK = 6        # One block of a streamed chain.
+BC_END = 7          # End of a streamed chain.
+BC_ACK = 8          # A window of a streamed chain was added.
+BC_STOP = 9         # The receiver doesn't want the rest of a streamed chain.
+REQ_PROOF = 10      # Request for the merkle proof of a transaction.
+RECV_PROOF = 11     # Merkle proof of a transaction with the header of its block.
+REQ_SNAPSHOT = 12   # Request for the latest state snapshot. Payload 'hash' : only its content hash.
+SNAPSHOT = 13       # State snapshot (or only its content hash), tied to a block of the sender's chain.
+BC_ACCEPT = 14      # The receiver takes a streamed chain, with the codec it picked (empty: none).
+BC_ZBLOCK = 15      # One compressed block of a streamed chain.
+INV = 16            # Announcement of new blocks and transactions, by hash (see inventory.py).
+GET_DATA = 17       # Request for announced items. Answered with NEW_BLOCK and TRANSACTION messages.
+GET_HEADERS = 18    # Request for the headers after the fork point of a block locator (see sync.py).
+HEADERS = 19        # Headers answering GET_HEADERS. Empty when the sender has nothing newer.
+
+
+def send_frame(sock, msg_type:int, payload=b""):
+    '''
+    Send one frame. {payload} is bytes or str.
+    '''
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(payload), msg_type) + payload)
+
+
+class FrameReader:
+    '''
+    Reads the frames of a connection into one preallocated buffer with
+    recv_into(), so receiving a frame doesn't build intermediate bytes
+    objects. Payloads are handed out as memoryviews on the buffer, only
+    valid until the next read().
+    '''
+
+    def __init__(self, sock, size:int=INITIAL_BUFFER):
+        self.sock = sock
+        self.header = bytearray(FRAME_HEADER.size)
+        self.buffer = bytearray(size)
+
+    def fill(self, view):
+        '''
+        Receive exactly len(view) bytes into {view}.
+
+        Returns : False if the connection was closed first.
+        '''
+        got = 0
+        while got < len(view):
+            n = self.sock.recv_into(view[got:])
+            if n == 0:
+                return False
+            got += n
+        return True
+
+    def read(self):
+        '''
+        Returns : (message type, payload as a memoryview), or None if the connection was closed.
+        '''
+        if not self.fill(memoryview(self.header)):
+            return None
+        size, msg_type = FRAME_HEADER.unpack(self.header)
+        if size > MAX_FRAME:
+            raise ConnectionError(f"Frame of {size} bytes is too large.")
+        if size > len(self.buffer):
+            # A new buffer rather than a resize: views on the old one may still be alive.
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        payload = memoryview(self.buffer)[:size]
+        if not self.fill(payload):
+            return None
+        return msg_type, payload
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    '''
+    The asyncio counterpart of FrameReader. The event loop receives straight
+    into one buffer per connection (get_buffer / buffer_updated), complete
+    frames are cut out of it and passed to {on_frame}. The buffer is only
+    moved or grown in get_buffer(), when the event loop holds no view on it.
+
+    on_frame(msg_type, payload) gets a copy of the payload: it is handled
+    later, on another thread. on_frame(None, None) means the connection is closed.
+    '''
+
+    def __init__(self, on_frame, size:int=INITIAL_BUFFER):
+        self.on_frame = on_frame
+        self.transport = None
+        self.buffer = bytearray(size)
+        self.start = 0      # First byte of the frame being received.
+        self.end = 0        # End of the received bytes.
+        self.needed = FRAME_HEADER.size     # Size of the frame being received, as far as we know.
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.start + self.needed > len(self.buffer):
+            # The frame doesn't fit where it starts: move it to the front, in a larger buffer if needed.
+            pending = self.buffer[self.start:self.end]
+            if self.needed > len(self.buffer):
+                self.buffer = bytearray(max(self.needed, 2 * len(self.buffer)))
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        while self.end - self.start >= FRAME_HEADER.size:
+            size, msg_type = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if size > MAX_FRAME:
+                print(f"Frame of {size} bytes is too large. Dropping the connection.")
+                self.transport.close()
+                return
+            self.needed = FRAME_HEADER.size + size
+            if self.end - self.start < self.needed:
+                return
+            payload = self.start + FRAME_HEADER.size
+            self.on_frame(msg_type, bytes(self.buffer[payload:payload + size]))
+            self.start += self.needed
+            self.needed = FRAME_HEADER.size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def connection_lost(self, exc):
+        self.on_frame(None, None)
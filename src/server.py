@@ -0,0 +1,152 @@
+import asyncio
+import queue
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from protocol import FrameProtocol
+
+# Threads running the message handlers. Handlers decode and validate blocks,
+# which is too slow for the event loop.
+HANDLER_WORKERS = 32
+
+# Frames queued on a connection before we stop reading from it. Reading
+# resumes once the handlers caught up with half of them.
+MAX_QUEUED = 256
+
+# Seconds a handler waits for the next frame of its connection (e.g. the next
+# block of a streamed chain) before giving up.
+READ_TIMEOUT = 30
+
+# Pending connections the listening socket accepts.
+BACKLOG = 1024
+
+
+class Channel:
+    '''
+    The handler side of an inbound connection. The event loop queues the
+    frames of the connection, and they are handled in order, by one executor
+    thread at a time, so connections don't wait for each other.
+
+    A handler that needs the next frames of its connection (e.g. a streamed
+    chain) reads them with read(), and its replies sent with sendall() are
+    written by the event loop. A Channel is its own "sock", so handlers
+    written for a FrameReader on a blocking socket work unchanged.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.addr = None
+        self.sock = self
+        self.transport = None
+        self.frames = queue.Queue()
+        self.lock = Lock()
+        self.running = False    # An executor thread is handling the frames of this connection.
+        self.paused = False     # We stopped reading from the connection.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+
+    def push(self, msg_type, payload):
+        '''
+        Called by the event loop with every frame, and with (None, None) once the connection is closed.
+        '''
+        with self.lock:
+            self.frames.put(None if msg_type is None else (msg_type, payload))
+            if not self.running:
+                self.running = True
+                self.loop.run_in_executor(self.server.executor, self.work)
+        if msg_type is not None and not self.paused and self.frames.qsize() >= MAX_QUEUED:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def work(self):
+        '''
+        Handle the queued frames of the connection, until there is none left.
+        '''
+        while True:
+            with self.lock:
+                if self.frames.empty():
+                    self.running = False
+                    return
+            frame = self.read()
+            if frame is None:
+                return
+            msg_type, payload = frame
+            try:
+                self.server.handler(msg_type, payload, self, self.addr)
+            except Exception as e:
+                print("Error during communication:", e)
+
+    def read(self):
+        '''
+        The next frame of the connection, like FrameReader.read().
+
+        Returns : (message type, payload as a memoryview), or None if the connection was closed.
+        '''
+        try:
+            frame = self.frames.get(timeout=READ_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(f"No message from {self.addr[0]} for {READ_TIMEOUT} seconds.")
+        if self.paused and self.frames.qsize() <= MAX_QUEUED // 2:
+            self.loop.call_soon_threadsafe(self.resume)
+        if frame is None:
+            return None
+        return frame[0], memoryview(frame[1])
+
+    def resume(self):
+        if self.paused and not self.transport.is_closing():
+            self.paused = False
+            self.transport.resume_reading()
+
+    def sendall(self, data):
+        self.loop.call_soon_threadsafe(self.transport.write, bytes(data))
+
+
+class PeerServer:
+    '''
+    Serves the inbound peer connections on one asyncio event loop, and runs
+    handler(msg_type, payload, channel, addr) for every received frame on a
+    pool of HANDLER_WORKERS threads.
+    '''
+
+    def __init__(self, handler, port:int, workers:int=HANDLER_WORKERS):
+        self.handler = handler
+        self.port = port
+        self.workers = workers
+        self.loop = None
+        self.executor = None
+
+    def run(self):
+        '''
+        Serve forever. Blocks the calling thread, which runs the event loop.
+        '''
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='handler')
+        server = await self.loop.create_server(self.connection, "0.0.0.0", self.port, backlog=BACKLOG)
+        print("Stay thread started. Listening .....")
+        async with server:
+            await server.serve_forever()
+
+    def connection(self):
+        '''
+        Protocol factory of the server.
+        '''
+        return PeerConnection(Channel(self))
+
+
+class PeerConnection(FrameProtocol):
+    '''
+    An inbound connection: its frames go to a Channel.
+    '''
+
+    def __init__(self, channel):
+        super().__init__(channel.push)
+        self.channel = channel
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.channel.connection_made(transport)
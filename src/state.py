@@ -0,0 +1,152 @@
+import json
+from hashlib import sha256
+
+
+class SongState:
+    '''
+    World state of the main chain: who currently owns every registered song,
+    and the set of artists that appear on chain.
+
+    Updated block by block as the chain grows. Every applied block leaves an
+    undo record (the entries it overwrote), so a block rolled back during a
+    reorg is reverted in O(transactions) without replaying the chain.
+
+    The state can be exported as a snapshot tied to a block. A snapshot is
+    canonical JSON, so two peers with the same state produce the same bytes
+    and the same content hash.
+    '''
+
+    def __init__(self):
+        self.songs = {}     # key: song name. value: (owner, song hash, registration height).
+        self.by_hash = {}   # key: song hash. value: song name.
+        self.artists = set()
+        self.undo = {}      # key: height. value: ([(song name, previous entry or None), ...], new artists)
+        self.height = -1    # Height of the last applied block.
+
+    def __len__(self):
+        return len(self.songs)
+
+    def owner_of(self, song_name:str=None, song_hash:str=None):
+        '''
+        Current owner of a song, looked up by name or by hash. O(1).
+
+        Returns : The owner's user name, or None if the song is not registered.
+        '''
+        if song_name is None:
+            song_name = self.by_hash.get(song_hash)
+        entry = self.songs.get(song_name)
+        return entry[0] if entry else None
+
+    def registered_at(self, song_name:str):
+        '''
+        Height of the block that registered the song, or None.
+        '''
+        entry = self.songs.get(song_name)
+        return entry[2] if entry else None
+
+    def check_transfer(self, user_name:str, song_name:str, other_user:str):
+        '''
+        Checks a transfer against the current state.
+
+        Returns : An error message, or None if the transfer is valid.
+        '''
+        owner = self.owner_of(song_name)
+        if owner is None:
+            return "Song has not been registered yet !"
+        elif owner != user_name:
+            return "You are not the owner !"
+        elif owner == other_user:
+            return "Looks like the receiver already has the song !"
+        return None
+
+    def apply_block(self, transactions, height:int):
+        '''
+        Apply the transactions of the block at {height}. Registering a song that
+        is already registered, or transferring a song one doesn't own, is a no-op.
+        '''
+        undo, new_artists = [], []
+        for ts in transactions:
+            try:
+                ts = json.loads(ts)
+                ts_type, song_name = ts['transaction_type'], ts['song_name']
+            except (ValueError, TypeError, KeyError):
+                continue    # e.g. the genesis block.
+
+            entry = self.songs.get(song_name)
+            if ts_type == 'Register' and entry is None:
+                new_entry = (ts['user_name'], ts['song_hash'], height)
+            elif ts_type == 'Transfer' and entry is not None and entry[0] == ts['user_name'] and ts.get('other_user'):
+                new_entry = (ts['other_user'], entry[1], entry[2])
+            else:
+                continue
+
+            undo.append((song_name, entry))
+            self.set_entry(song_name, new_entry)
+            if new_entry[0] not in self.artists:
+                self.artists.add(new_entry[0])
+                new_artists.append(new_entry[0])
+
+        self.undo[height] = (undo, new_artists)
+        self.height = height
+
+    def revert_block(self, height:int):
+        '''
+        Undo the block at {height}, which must be the last applied one.
+
+        Returns : False if there is no undo record for it (the state was
+        loaded from a snapshot taken above it), in which case nothing changes.
+        '''
+        if height not in self.undo:
+            return False
+        undo, new_artists = self.undo.pop(height)
+        for song_name, entry in reversed(undo):
+            self.set_entry(song_name, entry)
+        self.artists.difference_update(new_artists)
+        self.height = height - 1
+        return True
+
+    def set_entry(self, song_name:str, entry):
+        old = self.songs.get(song_name)
+        if old is not None:
+            self.by_hash.pop(old[1], None)
+        if entry is None:
+            self.songs.pop(song_name, None)
+        else:
+            self.songs[song_name] = entry
+            self.by_hash[entry[1]] = song_name
+
+    def snapshot(self, block_hash:str):
+        '''
+        Export the state as of the last applied block, whose hash is {block_hash}.
+
+        Returns : The snapshot, as canonical JSON bytes.
+        '''
+        data = {
+            'height':       self.height,
+            'block_hash':   block_hash,
+            'songs':        {name: list(entry) for name, entry in self.songs.items()},
+            'artists':      sorted(self.artists)
+        }
+        return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+    @classmethod
+    def from_snapshot(cls, data:bytes):
+        '''
+        Rebuild a state from a snapshot. There is no undo record below it.
+
+        Returns : (state, height, block hash)
+        '''
+        data = json.loads(data)
+        state = cls()
+        for name, entry in data['songs'].items():
+            state.set_entry(name, tuple(entry))
+        state.artists = set(data['artists'])
+        state.height = data['height']
+        return state, data['height'], data['block_hash']
+
+
+def snapshot_hash(data:bytes):
+    '''
+    Content hash of a snapshot.
+    '''
+    return sha256(data).hexdigest()
@@ -0,0 +1,372 @@
+import os
+import mmap
+from zlib import crc32
+from struct import pack, unpack, unpack_from
+from threading import Lock
+from collections import OrderedDict
+
+# Blocks are appended to segment files of at most SEGMENT_SIZE bytes.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Record layout in a segment : [length (4)][crc32 (4)][payload (length)]
+RECORD_HEADER = 8
+
+# Index layout : one entry per block, [segment (4)][offset (4)][length (4)]
+INDEX_ENTRY = 12
+
+# The records are synced to disk and their number saved (checked.dat) every
+# CHECKPOINT_INTERVAL appends. On open, only the records after it are checksummed.
+CHECKPOINT_INTERVAL = 1000
+
+
+class ChainStore:
+    '''
+    Append-only on-disk store for serialized blocks.
+
+    Records are appended to numbered segment files and located through an
+    offset index (index.dat) with one fixed-size entry per height. Data is
+    written before its index entry, so after a crash the index is at worst
+    behind the segments: on open it is checked against the data, records
+    that were written but not indexed are recovered by scanning, and a torn
+    or corrupted tail is cut off. The records up to the last checkpoint are
+    on disk for sure, their checksums aren't checked again on open, so a
+    restart only reads what was appended since. Reads go through
+    memory-mapped segments.
+    Views are only safe while {lock} is held: truncate() shrinks the mapped
+    files, and touching a mapping past the end of its file is fatal (SIGBUS).
+    '''
+
+    def __init__(self, directory:str, sync:bool=False):
+        self.directory = directory
+        self.sync = sync            # fsync after every append.
+        self.entries = []           # height -> (segment, offset, length)
+        self.maps = {}              # segment -> (size, mmap)
+        self.lock = Lock()          # Held by writers, and by readers while they use a view.
+        self.checked = 0            # Number of records synced to disk at the last checkpoint.
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.index_file = open(self.index_path(), 'ab')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def segment_path(self, segment:int):
+        return os.path.join(self.directory, f"blk{segment:05d}.dat")
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.dat")
+
+    def recover(self):
+        '''
+        Load the index, drop entries that don't point to a valid record, then
+        scan the segments for valid records that are missing from the index.
+        Anything after the last valid record is truncated. The records before
+        the last checkpoint are only checked to be in their segment.
+        '''
+        entries = []
+        if os.path.exists(self.index_path()):
+            with open(self.index_path(), 'rb') as f:
+                raw = f.read()
+            for i in range(len(raw) // INDEX_ENTRY):
+                entries.append(unpack_from('>III', raw, i * INDEX_ENTRY))
+
+        saved = self.load_meta("checked.dat")
+        checked = unpack('>I', saved)[0] if saved is not None and len(saved) == 4 else 0
+
+        # Keep the longest prefix of the index that points to valid records.
+        sizes = {}
+        valid = 0
+        for segment, offset, length in entries:
+            if valid < checked:
+                if segment not in sizes:
+                    path = self.segment_path(segment)
+                    sizes[segment] = os.path.getsize(path) if os.path.exists(path) else 0
+                if offset + RECORD_HEADER + length > sizes[segment]:
+                    break
+            elif self.read_record(segment, offset) is None:
+                break
+            valid += 1
+        self.entries = entries[:valid]
+
+        # Records written after the last indexed one.
+        if self.entries:
+            segment, offset, length = self.entries[-1]
+            offset += RECORD_HEADER + length
+        else:
+            segment, offset = 0, 0
+        while os.path.exists(self.segment_path(segment)):
+            payload = self.read_record(segment, offset)
+            if payload is None:
+                # Torn or corrupted tail. Cut it, along with any later segment.
+                with open(self.segment_path(segment), 'r+b') as f:
+                    f.truncate(offset)
+                next_segment = segment + 1
+                while os.path.exists(self.segment_path(next_segment)):
+                    os.remove(self.segment_path(next_segment))
+                    next_segment += 1
+                break
+            self.entries.append((segment, offset, len(payload)))
+            offset += RECORD_HEADER + len(payload)
+            if offset >= SEGMENT_SIZE:
+                segment, offset = segment + 1, 0
+
+        self.close_maps()
+        with open(self.index_path(), 'wb') as f:
+            f.write(b"".join(pack('>III', *e) for e in self.entries))
+        self.checked = min(checked, len(self.entries))
+        if self.checked != checked:
+            self.save_meta("checked.dat", pack('>I', self.checked))
+        self.checkpoint()
+
+    def read_record(self, segment:int, offset:int):
+        '''
+        Returns : The payload of the record at {offset} as a memoryview, or
+        None if there is no complete record with a matching checksum there.
+        '''
+        data = self.segment_map(segment)
+        if data is None or offset + RECORD_HEADER > len(data):
+            return None
+        length, checksum = unpack_from('>II', data, offset)
+        start = offset + RECORD_HEADER
+        if start + length > len(data):
+            return None
+        payload = memoryview(data)[start:start + length]
+        if crc32(payload) != checksum:
+            return None
+        return payload
+
+    def segment_map(self, segment:int):
+        '''
+        Memory map of a segment, remapped if the file grew since the last call.
+        '''
+        path = self.segment_path(segment)
+        if not os.path.exists(path):
+            return None
+        size = os.path.getsize(path)
+        cached = self.maps.get(segment)
+        if cached and cached[0] == size:
+            return cached[1]
+        if size == 0:
+            return b""
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment] = (size, data)
+        return data
+
+    def close_maps(self):
+        # Old maps may still be referenced by memoryviews handed out; let them be collected.
+        self.maps = {}
+
+    def get(self, height:int):
+        '''
+        Returns : The payload stored at {height}, as a memoryview on the mapped
+        segment. Hold {lock} until done with it.
+        '''
+        segment, offset, length = self.entries[height]
+        start = offset + RECORD_HEADER
+        return memoryview(self.segment_map(segment))[start:start + length]
+
+    def append(self, payload:bytes):
+        '''
+        Append a record at the next height. The data is flushed before its index entry.
+        '''
+        with self.lock:
+            self.append_record(payload)
+
+    def append_record(self, payload:bytes):
+        if self.entries:
+            segment, offset, length = self.entries[-1]
+            offset += RECORD_HEADER + length
+            if offset >= SEGMENT_SIZE:
+                segment, offset = segment + 1, 0
+        else:
+            segment, offset = 0, 0
+
+        with open(self.segment_path(segment), 'ab') as f:
+            f.write(pack('>II', len(payload), crc32(payload)) + payload)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+
+        self.index_file.write(pack('>III', segment, offset, len(payload)))
+        self.index_file.flush()
+        if self.sync:
+            os.fsync(self.index_file.fileno())
+        self.entries.append((segment, offset, len(payload)))
+        if len(self.entries) - self.checked >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''
+        Sync the records appended since the last checkpoint to disk, then save their number.
+        '''
+        if self.checked == len(self.entries):
+            return
+        for segment in sorted({entry[0] for entry in self.entries[self.checked:]}):
+            with open(self.segment_path(segment), 'rb') as f:
+                os.fsync(f.fileno())
+        with open(self.index_path(), 'rb') as f:
+            os.fsync(f.fileno())
+        self.checked = len(self.entries)
+        self.save_meta("checked.dat", pack('>I', self.checked))
+
+    def truncate(self, height:int):
+        '''
+        Drop every record at {height} and above. Used when the chain is replaced.
+        '''
+        with self.lock:
+            self.truncate_records(height)
+
+    def truncate_records(self, height:int):
+        if height >= len(self.entries):
+            return
+        # The records written at these heights from now on aren't synced yet.
+        if height < self.checked:
+            self.checked = height
+            self.save_meta("checked.dat", pack('>I', self.checked))
+        segment, offset, _ = self.entries[height]
+        self.close_maps()
+        with open(self.segment_path(segment), 'r+b') as f:
+            f.truncate(offset)
+        next_segment = segment + 1
+        while os.path.exists(self.segment_path(next_segment)):
+            os.remove(self.segment_path(next_segment))
+            next_segment += 1
+
+        del self.entries[height:]
+        self.index_file.truncate(height * INDEX_ENTRY)
+        self.index_file.seek(0, os.SEEK_END)
+
+    def save_meta(self, name:str, data:bytes):
+        '''
+        Atomically replace a side file of the store, e.g. the state snapshot.
+        '''
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def load_meta(self, name:str):
+        '''
+        Returns : The content of a side file of the store, or None.
+        '''
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        with self.lock:
+            self.checkpoint()
+            self.index_file.close()
+            self.close_maps()
+
+
+class RecordFile:
+    '''
+    Append-only file of fixed-size records, one per height, kept next to a
+    ChainStore (e.g. the headers, so a restart doesn't decode every block).
+    It is appended to after the store and cut before it, so it never gets
+    ahead of the store, but it may be behind it after a crash.
+    '''
+
+    def __init__(self, path:str, record_size:int, sync:bool=False):
+        self.path = path
+        self.record_size = record_size
+        self.sync = sync
+        self.file = open(path, 'ab')
+        self.count = self.file.tell() // record_size
+        # A record torn by a crash.
+        self.file.truncate(self.count * record_size)
+        self.file.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self.count
+
+    def read(self, count:int):
+        '''
+        Returns : The first {count} records, back to back.
+        '''
+        with open(self.path, 'rb') as f:
+            return f.read(count * self.record_size)
+
+    def append(self, record:bytes):
+        self.file.write(record)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.count += 1
+
+    def truncate(self, count:int):
+        '''
+        Keep the first {count} records.
+        '''
+        if count < self.count:
+            self.file.truncate(count * self.record_size)
+            self.file.seek(0, os.SEEK_END)
+            self.count = count
+
+    def close(self):
+        self.file.close()
+
+
+class BodyCache:
+    '''
+    LRU cache of block bodies loaded on demand from a backing store.
+    Evicts the least recently used bodies once their total size goes over
+    max_bytes. Keyed by block height. Thread safe: a body is loaded and
+    cached under the lock, so a discard() can't be overtaken by a stale load.
+    '''
+
+    def __init__(self, loader, max_bytes:int):
+        self.loader = loader        # height -> BlockBody, reads the backing store.
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # height -> (body, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, height:int):
+        with self.lock:
+            entry = self.entries.get(height)
+            if entry is not None:
+                self.entries.move_to_end(height)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            body = self.loader(height)
+            size = body_size(body)
+            self.entries[height] = (body, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+            return body
+
+    def discard(self, height:int):
+        with self.lock:
+            entry = self.entries.pop(height, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+
+def body_size(body):
+    '''
+    Approximate memory used by a block body, in bytes.
+    '''
+    return 64 + len(body.signature) + sum(64 + len(ts) for ts in body.transactions)
@@ -0,0 +1,129 @@
+import time
+from codec import CodecError
+
+# Headers in one HEADERS message, at most.
+MAX_HEADERS = 2000
+
+# Blocks asked from one peer in one GET_DATA message.
+SYNC_RANGE = 64
+
+# Seconds to wait for headers or blocks before asking another peer.
+SYNC_TIMEOUT = 10
+
+
+def encode_locator(locator):
+    '''
+    Encoding of a block locator (see Blockchain.locator()): the 32-byte hashes back to back.
+    '''
+    return b"".join(bytes.fromhex(blk_hash) for blk_hash in locator)
+
+
+def decode_locator(buf):
+    if len(buf) % 32:
+        raise CodecError(f"Malformed block locator of {len(buf)} bytes.")
+    return [bytes(buf[i:i + 32]).hex() for i in range(0, len(buf), 32)]
+
+
+class HeaderSync:
+    '''
+    State of a headers-first sync. Headers are downloaded from one peer, in
+    batches of MAX_HEADERS, starting at the fork point given by our block
+    locator. A batch with no more work than our chain may be the start of a
+    fork deeper than one batch, so the headers after it are asked for until
+    the work of the whole branch is known. Once a batch is validated and has
+    more work, the bodies of its blocks are asked
+    from all the peers at once, in ranges of SYNC_RANGE blocks, and connected
+    to the chain in order as they arrive. Then the next batch is asked for,
+    until a batch comes back short. The other peers are then asked in turn,
+    and the sync is over once none of them has more work than our chain.
+
+    Requests without an answer after SYNC_TIMEOUT go to another peer.
+    '''
+
+    def __init__(self, peer:str):
+        self.peer = peer            # The peer we download the headers from.
+        self.headers = []           # [(header, hash)] of the batch, validated, not connected yet.
+        self.branch = []            # [(header, hash)] validated, of a fork with no more work than our chain so far.
+        self.next = 0               # Position in self.headers of the next block to connect.
+        self.bodies = {}            # key: block hash. value: Block received but not connected yet.
+        self.requested = {}         # key: block hash. value: (peer, time the request expires).
+        self.last_batch = False     # The current batch is the last one.
+        self.synced = set()         # Peers that have nothing with more work than our chain.
+        self.headers_expire = time.time() + SYNC_TIMEOUT    # Waiting for headers until then. None if not waiting.
+
+    def set_headers(self, headers, last_batch:bool):
+        self.headers = headers
+        self.branch = []
+        self.next = 0
+        self.bodies = {}
+        self.requested = {}
+        self.last_batch = last_batch
+        self.headers_expire = None
+
+    def wait_headers(self, peer:str, resume:bool=False):
+        '''
+        Headers were asked from {peer}, after the branch if {resume}.
+        '''
+        if not resume:
+            self.branch = []
+        self.peer = peer
+        self.headers_expire = time.time() + SYNC_TIMEOUT
+
+    def expects(self, blk_hash:str):
+        return blk_hash in self.requested
+
+    def assign(self, hashes, peers):
+        '''
+        Spread the blocks {hashes} over {peers}, SYNC_RANGE consecutive blocks at a time.
+
+        Returns : {peer: [block hash]}
+        '''
+        expire = time.time() + SYNC_TIMEOUT
+        ranges = {}
+        for i, start in enumerate(range(0, len(hashes), SYNC_RANGE)):
+            peer = peers[i % len(peers)]
+            for blk_hash in hashes[start:start + SYNC_RANGE]:
+                self.requested[blk_hash] = (peer, expire)
+                ranges.setdefault(peer, []).append(blk_hash)
+        return ranges
+
+    def request_batch(self, peers):
+        '''
+        Returns : {peer: [block hash]}, the blocks of the new batch to ask for.
+        '''
+        return self.assign([blk_hash for _, blk_hash in self.headers], peers)
+
+    def expired(self, peers):
+        '''
+        The blocks whose request expired, each to ask from a peer other than
+        the one that didn't answer.
+
+        Returns : {peer: [block hash]}
+        '''
+        now = time.time()
+        ranges = {}
+        for peer in {p for p, _ in self.requested.values()}:
+            expired = [h for h, (p, expire) in self.requested.items() if p == peer and expire < now]
+            if expired:
+                others = [p for p in peers if p != peer] or peers
+                for other, hashes in self.assign(expired, others).items():
+                    ranges.setdefault(other, []).extend(hashes)
+        return ranges
+
+    def add_body(self, block, blk_hash:str):
+        del self.requested[blk_hash]
+        self.bodies[blk_hash] = block
+
+    def ready(self):
+        '''
+        Blocks of the batch that can be connected now, in order: the ones
+        received right after the last connected one.
+        '''
+        blocks = []
+        while self.next < len(self.headers) and self.headers[self.next][1] in self.bodies:
+            blocks.append(self.bodies.pop(self.headers[self.next][1]))
+            self.next += 1
+        return blocks
+
+    def batch_done(self):
+        return self.next == len(self.headers)
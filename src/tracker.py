@@ -1,6 +1,7 @@
 import time
 import socket
-from struct import pack
+import protocol as msg
+from protocol import send_frame
 from threading import Thread, Lock
 
 class Tracker:
@@ -99,21 +100,21 @@ class Tracker:
         Sends an updated peer list to all peers.
         """
         with self.lock:
-            message = "PEER_LIST:" + str(list(self.peers.keys()))
+            message = str(list(self.peers.keys()))
         for peer in self.peers:
             print(f"sent to {peer}")
             self.send_message(peer, message)
 
     def send_message(self, peer_addr, message):
         """
-        Sends specific message to a specific peer in the network of peers.
+        Sends the peer list to a specific peer in the network of peers, as a PEER_LIST frame.
         """
         # Create a new socket
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 # peer addr should be (host, port), assume peers are listening on port 54321 for tracker's message.
                 s.connect((peer_addr, 54321))
-                s.sendall(pack('>I', len(message)) + message.encode())
+                send_frame(s, msg.PEER_LIST, message)
         
         except Exception as e:
             print(f"Failed to send message to peer: {peer_addr}, {e}")
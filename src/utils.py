@@ -3,86 +3,132 @@ from datetime import datetime
 
 record = False
 
+# Format of block and transaction timestamps.
+TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
 def time_difference(start_time_str, end_time_str):
     '''
     Calculates the time difference between two datetime strings.
     '''
-    time_format = "%m/%d/%Y, %H:%M:%S"
-
-    start_time = datetime.strptime(start_time_str, time_format)
-    end_time = datetime.strptime(end_time_str, time_format)
+    start_time = datetime.strptime(start_time_str, TIME_FORMAT)
+    end_time = datetime.strptime(end_time_str, TIME_FORMAT)
     
     delta = end_time - start_time
     return delta.total_seconds()
 
-def switch_difficulty(mine_time:float, curr_difficulty:str):
+# Difficulty is a 256-bit target. A block's PoW is valid if its digest, read
+# as a big-endian number, is smaller than the target.
+MAX_TARGET = 1 << 236           # Easiest allowed, 5 leading zero hex digits. Used by the genesis block.
+INITIAL_TARGET = 3 << 232       # Target until there are enough blocks to retarget.
+
+# Retargeting. The target of the next block is derived from the timestamps
+# of the last RETARGET_WINDOW blocks, so every peer computes the same value.
+TARGET_BLOCK_TIME = 15          # Seconds.
+RETARGET_WINDOW = 10            # Blocks.
+MAX_RETARGET_FACTOR = 4         # Max change of the target in one step.
+
+# Timestamps drive the retarget, so they are bounded: a block must be later
+# than the median timestamp of the window of blocks before it, and at most
+# MAX_FUTURE_TIME ahead of the local clock.
+MAX_FUTURE_TIME = 2 * 60 * 60   # Seconds.
+
+def median_time(window):
     '''
-    Switches the difficulty level based on the mining time.
+    Median timestamp of a window of blocks, as a datetime. None if the window is empty.
     '''
+    if not window:
+        return None
+    times = sorted(datetime.strptime(b.timestamp, TIME_FORMAT) for b in window)
+    return times[len(times) // 2]
 
-    if float(mine_time) < 10:
-        if curr_difficulty == "easy":
-            print("Difficulty level switched from easy to medium")
-            curr_difficulty = "medium"
-        elif curr_difficulty == "medium":
-            print("Difficulty level switched from medium to hard")
-            curr_difficulty = "hard"
-    if float(mine_time) > 20:
-        if curr_difficulty == "medium":
-            print("Difficulty level switched from medium to easy")
-            curr_difficulty = "easy"
-        elif curr_difficulty == "hard":
-            print("Difficulty level switched from hard to medium")
-            curr_difficulty = "medium"
+def timestamp_valid(timestamp:str, window):
+    '''
+    Checks the timestamp of a block against the window of blocks before it
+    (oldest first, genesis excluded) and the local clock.
 
-    return curr_difficulty
+    Returns : True if the timestamp is after the median of the window and not too far ahead.
+    '''
+    try:
+        time = datetime.strptime(timestamp, TIME_FORMAT)
+        median = median_time(window)
+    except (ValueError, TypeError):
+        return False
+    if (time - datetime.now()).total_seconds() > MAX_FUTURE_TIME:
+        return False
+    return median is None or time > median
 
-def meet_hash_criteria(data, difficulty:str):
+def target_bytes(target:int):
     '''
-    Checks if the hash of the data meets the difficulty criteria.
+    Returns the target as 32 raw big-endian bytes, comparable with a digest.
+    '''
+    return min(int(target), MAX_TARGET).to_bytes(32, 'big')
 
-    Difficulty Level     Criteria
-    'easy'               Hash must start with 5 zeros
-    'medium'             Hash must start with '000000', '000001' or '000002'
-    'hard'               Hash must start with 6 zeros
+def meet_hash_criteria(digest:bytes, target:int):
+    '''
+    Checks if the raw sha256 digest meets the target.
 
-    Returns : True if the hash meets the difficulty criteria.
+    Returns : True if the hash is smaller than the target.
     '''
 
-    if difficulty not in ['easy', 'medium', 'hard']:
-        print("Warning : Invalid difficulty level! Using 'easy' as default.")
-        return data.startswith('0' * 5)
+    return digest < target_bytes(target)
 
-    if difficulty == 'easy':
-        return data.startswith('0' * 5)
-    elif difficulty == 'medium':
-        return data.startswith('000000') or data.startswith('000001') or data.startswith('000002')
-    elif difficulty == 'hard':
-        return data.startswith('0' * 6)
-    else:
-        return False
+def block_work(target:int):
+    '''
+    Expected number of hashes needed to mine a block at {target}.
+    The best chain is the one with the most cumulative work.
+    '''
+    return (1 << 256) // (int(target) + 1)
 
-record = True
+def retarget(window):
+    '''
+    Calculates the target of the next block from a window of the most recent
+    blocks (oldest first, genesis excluded). The average target of the window
+    is scaled by how long the window actually took against how long it should
+    have taken.
 
-def calc_mrkl_root(data):
+    Returns : The target of the next block.
     '''
-    Calculates the merkle root of a list of transactions.
+    if len(window) < 2:
+        return INITIAL_TARGET
+
+    expected = (len(window) - 1) * TARGET_BLOCK_TIME
+    actual = time_difference(window[0].timestamp, window[-1].timestamp)
+    actual = max(expected / MAX_RETARGET_FACTOR, min(actual, expected * MAX_RETARGET_FACTOR))
+
+    avg_target = sum(int(b.difficulty) for b in window[1:]) // (len(window) - 1)
+    new_target = avg_target * int(actual) // expected
+    return max(1, min(new_target, MAX_TARGET))
+
+# Number of nonces tried between two checks of a stop/cancel flag while mining.
+# About a few milliseconds of hashing.
+CHECK_INTERVAL = 1 << 12
+
+def find_nonce(midstate, target:bytes, start:int, step:int=1, tries:int=None):
     '''
+    The mining hot loop. midstate is a sha256 object that has already consumed
+    the constant part of the block header, so every try only hashes the nonce
+    and compares raw digest bytes against the target.
 
-    if not data:
-        return 0
+    Returns : The first nonce that meets the target, or None after {tries} tries.
+    '''
+    copy = midstate.copy
+    nonce = start
+    end = None if tries is None else start + tries * step
+    while nonce != end:
+        h = copy()
+        h.update(b'%d' % nonce)
+        if h.digest() < target:
+            return nonce
+        nonce += step
+    return None
 
-    if type(data) == str:
-        data = [data]
+record = True
 
-    if len(data) == 1:
-        return data[0]
-    if len(data) % 2 != 0:
-        data.append(data[-1])
-    new_data = []
-    for i in range(0, len(data), 2):
-        new_data.append(sha256(data[i].encode() + data[i+1].encode()).hexdigest())
-    return calc_mrkl_root(new_data)
+def header_prefix(index, timestamp, previous_hash, mrkl_root):
+    '''
+    The part of a block header that is hashed before the nonce.
+    '''
+    return (str(index) + str(timestamp) + str(previous_hash) + str(mrkl_root)).encode()
 
 def hash_song(filename):
     '''
@@ -0,0 +1,42 @@
+import os
+import multiprocessing as mp
+from hashlib import sha256
+
+# Below this many headers, hashing them in the parent is faster than shipping them to a pool.
+PARALLEL_THRESHOLD = 2000
+
+# Headers handed to a worker at once.
+CHUNK_SIZE = 512
+
+
+def hash_header(item):
+    '''
+    Hash one header from its prefix and nonce. Runs in a worker process.
+
+    Returns : The raw digest of the header.
+    '''
+    prefix, nonce = item
+    return sha256(prefix + b'%d' % nonce).digest()
+
+
+def make_pool(workers=None):
+    '''
+    Process pool for hash_headers(). Its workers are started by a fork
+    server, so it can be made while the peer already runs threads.
+    '''
+    return mp.get_context('forkserver').Pool(workers or os.cpu_count() or 1)
+
+
+def hash_headers(headers, pool=None):
+    '''
+    Hashes {headers} again, without using the digests cached by sealing.
+    The hashes are independent, so they are spread over the process pool
+    when there are enough of them. The checks that depend on the previous
+    headers (linkage, target) are left to the caller's serial pass.
+
+    Returns : [raw digest] of the headers, in order.
+    '''
+    items = [(header.prefix(), header.nonce) for header in headers]
+    if pool is not None and len(items) >= PARALLEL_THRESHOLD:
+        return pool.map(hash_header, items, chunksize=CHUNK_SIZE)
+    return [hash_header(item) for item in items]